@@ -0,0 +1,293 @@
+"""Load test every endpoint on this machine.
+
+Runs the app on a local server against a seeded database, with a stub
+server standing in for the urls bookmarks point to. Each scenario makes
+--requests requests from --concurrency threads, and reports requests per
+second and p50/p99 latency.
+
+Results are compared with a saved baseline, and the run fails if any
+scenario got slower than --tolerance allows. Save a baseline on a quiet
+machine first:
+
+    python benchmarks/bench_endpoints.py --save-baseline
+    python benchmarks/bench_endpoints.py
+    python benchmarks/bench_endpoints.py --latency 50 --redirects 3 \\
+        --scenarios create create_redirects
+
+Pass --database-uri to use an empty local PostgreSQL database instead of
+a SQLite file. It is seeded and then dropped.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+parser.add_argument('--database-uri',
+                    help='local database to use instead of a SQLite file')
+parser.add_argument('--users', type=int, default=10)
+parser.add_argument('--bookmarks', type=int, default=1000,
+                    help='bookmarks per user')
+parser.add_argument('--requests', type=int, default=500,
+                    help='requests per scenario')
+parser.add_argument('--concurrency', type=int, default=8)
+parser.add_argument('--latency', type=float, default=0,
+                    help='milliseconds the stub url server takes to respond')
+parser.add_argument('--redirects', type=int, default=2,
+                    help='redirects made by urls in create_redirects')
+parser.add_argument('--scenarios', nargs='+',
+                    help='scenarios to run, instead of all of them')
+parser.add_argument('--baseline', default=os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'baseline.json'))
+parser.add_argument('--save-baseline', action='store_true',
+                    help='save results as the new baseline')
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help='allowed fraction of slowdown from the baseline')
+args = parser.parse_args()
+
+# Point the app at the database before it is imported. Rate limits would
+# only measure how fast requests are refused, so are set out of reach.
+tmp = tempfile.mkdtemp()
+database_uri = args.database_uri or 'sqlite:///{}'.format(
+    os.path.join(tmp, 'bench.db'))
+settings = os.path.join(tmp, 'settings.py')
+with open(settings, 'w') as f:
+    f.write('DATABASE_URI = {!r}\n'.format(database_uri))
+    f.write('DEBUG = False\n')
+    f.write('RATE_LIMIT_READ_BURST = RATE_LIMIT_CREATE_BURST = 10 ** 9\n')
+os.environ['BOOKMARKS_SERVICE_SETTINGS'] = settings
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from bookmarks_service import app  # noqa: E402
+from bookmarks_service.database import (Base, db_session, engine,  # noqa
+                                        init_db)
+from bookmarks_service.ids import RandomAllocator  # noqa: E402
+from bookmarks_service.models import (User, SuperUser, Bookmark,  # noqa
+                                      API_Key)
+from bookmarks_service.utils import url_hash  # noqa: E402
+
+PASSWORD = 'bench password'
+SECRET = 'bench secret'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Stands in for bookmarked urls. /ok responds after --latency, and
+    # /redirect/<n> redirects n times before reaching /ok.
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        time.sleep(args.latency / 1000)
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if parts[0] == 'redirect' and int(parts[1]) > 0:
+            self.send_response(302)
+            self.send_header('Location', '/redirect/{}'.format(
+                int(parts[1]) - 1))
+        elif parts[0] in ('ok', 'redirect'):
+            self.send_response(200)
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_HEAD
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def seed():
+    init_db()
+    db_session.add(SuperUser(PASSWORD))
+    for i in range(args.users):
+        db_session.add(User('User', 'user{}@example.com'.format(i), 'x'))
+    db_session.commit()
+    ids = RandomAllocator().allocate(args.users * args.bookmarks)
+    for user_id in range(1, args.users + 1):
+        user_ids = ids[(user_id - 1) * args.bookmarks:
+                       user_id * args.bookmarks]
+        urls = ['http://example.com/{}'.format(b_id) for b_id in user_ids]
+        engine.execute(Bookmark.__table__.insert(), [
+            {'id': b_id, 'url': url, 'url_hash': url_hash(url),
+             'user_id': user_id, 'status': 'verified', 'hits': 0}
+            for b_id, url in zip(user_ids, urls)])
+        engine.execute(API_Key.__table__.insert(), [
+            {'id': 'key{}'.format(user_id), 'secret': SECRET,
+             'user_id': user_id}])
+    return ids
+
+
+def scenarios(ids, stub_url):
+    # Each scenario makes request number i with a session, and gives the
+    # expected status code
+    def api_key(i):
+        return ('key{}'.format(i % args.users + 1), SECRET)
+
+    def bookmark(i):
+        # A bookmark belonging to api_key(i)
+        user = i % args.users
+        return ids[user * args.bookmarks + i % args.bookmarks]
+
+    return {
+        'list': (200, lambda s, i: s.get(
+            '/bookmarks', auth=api_key(i))),
+        'list_stream': (200, lambda s, i: s.get(
+            '/bookmarks?stream=True', auth=api_key(i))),
+        'get': (200, lambda s, i: s.get(
+            '/bookmarks/' + bookmark(i), auth=api_key(i))),
+        'redirect': (302, lambda s, i: s.get(
+            '/' + bookmark(i), allow_redirects=False)),
+        'create': (201, lambda s, i: s.post(
+            '/bookmarks', auth=api_key(i),
+            data={'url': '{}/ok?{}'.format(stub_url, i)})),
+        'create_redirects': (201, lambda s, i: s.post(
+            '/bookmarks', auth=api_key(i),
+            data={'url': '{}/redirect/{}?{}'.format(
+                stub_url, args.redirects, i), 'follow_redirects': 'True'})),
+        'auth_failure': (401, lambda s, i: s.get(
+            '/bookmarks', auth=(api_key(i)[0], 'wrong secret'))),
+        'admin_users': (200, lambda s, i: s.get(
+            '/users', auth=('1', PASSWORD))),
+        'admin_user': (200, lambda s, i: s.get(
+            '/users/{}'.format(i % args.users + 1), auth=('1', PASSWORD))),
+    }
+
+
+class Session(requests.Session):
+    # Session that prefixes paths with the app's url
+    def __init__(self, base_url):
+        super().__init__()
+        self.base_url = base_url
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, self.base_url + url, *args, **kwargs)
+
+
+def percentile(values, p):
+    # Nearest rank percentile of sorted values
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+def run(base_url, expected, make_request):
+    # Make the requests from several threads. Returns requests per second,
+    # p50 and p99 latency in milliseconds, and number of errors.
+    latencies = []
+    errors = []
+    counter = iter(range(args.requests))
+    lock = threading.Lock()
+
+    def worker():
+        session = Session(base_url)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                status = make_request(session, i).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status != expected:
+                    errors.append(status)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.5) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'errors': len(errors)
+    }, errors
+
+
+def regressions(name, result, baseline):
+    # Ways result is slower than baseline by more than the tolerance
+    found = []
+    if result['rps'] < baseline['rps'] * (1 - args.tolerance):
+        found.append('{} req/s fell from {:.0f} to {:.0f}'.format(
+            name, baseline['rps'], result['rps']))
+    for p in ('p50', 'p99'):
+        if result[p] > baseline[p] * (1 + args.tolerance):
+            found.append('{} {} rose from {:.1f} to {:.1f} ms'.format(
+                name, p, baseline[p], result[p]))
+    return found
+
+
+def main():
+    print('Seeding {} users with {} bookmarks each...'.format(
+        args.users, args.bookmarks))
+    ids = seed()
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    stub_url = serve(stub)
+    # Do not log every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    base_url = serve(server)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = {}
+    found = []
+    print('{:<18} {:>9} {:>9} {:>9} {:>7}'.format(
+        'scenario', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for name, (expected, make_request) in scenarios(ids, stub_url).items():
+        if args.scenarios and name not in args.scenarios:
+            continue
+        result, errors = run(base_url, expected, make_request)
+        results[name] = result
+        line = '{:<18} {rps:>9.0f} {p50:>9.1f} {p99:>9.1f} {errors:>7}'
+        if name in baseline:
+            line += '   (baseline {rps:.0f} req/s, p99 {p99:.1f} ms)'.format(
+                **baseline[name])
+            found += regressions(name, result, baseline[name])
+        print(line.format(name, **result))
+        if errors:
+            found.append('{} got {} unexpected responses, such as {}'.format(
+                name, len(errors), errors[0]))
+
+    server.shutdown()
+    stub.shutdown()
+    db_session.remove()
+    if args.database_uri:
+        Base.metadata.drop_all(bind=engine)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('\nSaved baseline to ' + args.baseline)
+        return 0
+    if found:
+        print('\nRegressions:\n  ' + '\n  '.join(found))
+        return 1
+    if not baseline:
+        print('\nNo baseline to compare with. Save one with --save-baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
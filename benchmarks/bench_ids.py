@@ -0,0 +1,102 @@
+"""Benchmark bookmark id allocators.
+
+Fills a SQLite table with bookmarks up to each --fills share of the id
+space, using each allocator's own ids, then inserts bookmarks one at a time
+the way POST /bookmarks does. Reports inserts per second, and the queries
+each allocator needed per id, which for the random allocator are its
+collision retries. Ids are shortened to --id-length characters, so the id
+space is small enough to really fill.
+
+    python benchmarks/bench_ids.py --id-length 3 --fills 0.5 0.9 0.99
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Point the app at a throwaway database before it is imported
+tmp = tempfile.mkdtemp()
+settings = os.path.join(tmp, 'settings.py')
+with open(settings, 'w') as f:
+    f.write("DATABASE_URI = 'sqlite:///{}'\n".format(
+        os.path.join(tmp, 'bench.db')))
+os.environ['BOOKMARKS_SERVICE_SETTINGS'] = settings
+
+from bookmarks_service import app  # noqa: E402
+from bookmarks_service.database import db_session, engine, init_db  # noqa
+from bookmarks_service.ids import (ALPHABET, PermutationAllocator,  # noqa
+                                   RandomAllocator, encode_id)
+from bookmarks_service.models import Bookmark, IdCounter, User  # noqa: E402
+from bookmarks_service.querylog import capture_queries  # noqa: E402
+
+
+def seed(name, length, taken):
+    # Empty table, then fill it with taken ids the way allocator name would
+    # have, like a database that has been in use. Returns the allocator.
+    engine.execute(Bookmark.__table__.delete())
+    engine.execute(IdCounter.__table__.delete())
+    space = len(ALPHABET) ** length
+    if name == 'random':
+        allocator = RandomAllocator(length)
+        ids = [encode_id(n, length)
+               for n in random.sample(range(space), taken)]
+    else:
+        allocator = PermutationAllocator(
+            'bench key', app.config['BOOKMARK_ID_BLOCK_SIZE'], 'bench',
+            length)
+        ids = allocator.allocate(taken)
+    for i in range(0, len(ids), 10000):
+        engine.execute(Bookmark.__table__.insert(), [
+            {'id': b_id, 'url': 'http://example.com/', 'user_id': 1,
+             'status': 'verified'} for b_id in ids[i:i + 10000]])
+    return allocator
+
+
+def bench_inserts(allocator, inserts):
+    # Returns inserts per second, and queries made allocating each id
+    queries = 0
+    start = time.perf_counter()
+    for _ in range(inserts):
+        with capture_queries() as log:
+            b_id = allocator.allocate(1)[0]
+        queries += log.count
+        db_session.add(Bookmark(id=b_id, url='http://example.com/',
+                                user_id=1))
+        db_session.commit()
+    return inserts / (time.perf_counter() - start), queries / inserts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--id-length', type=int, default=3,
+                        help='characters per id, 6 in production')
+    parser.add_argument('--fills', type=float, nargs='+',
+                        default=[0.5, 0.9, 0.99],
+                        help='share of the id space taken before inserting')
+    parser.add_argument('--inserts', type=int, default=400,
+                        help='bookmarks inserted per allocator and fill')
+    args = parser.parse_args()
+
+    init_db()
+    db_session.add(User('Bench', 'bench@example.com', 'x'))
+    db_session.commit()
+    space = len(ALPHABET) ** args.id_length
+    print('Id space of {} ids'.format(space))
+    print('{:<8} {:<12} {:>10} {:>12} {:>12}'.format(
+        'fill', 'allocator', 'inserts', 'inserts/s', 'queries/id'))
+    for fill in args.fills:
+        taken = int(space * fill)
+        # Never insert more than the ids left
+        inserts = min(args.inserts, space - taken)
+        for name in ('random', 'permutation'):
+            allocator = seed(name, args.id_length, taken)
+            rate, queries = bench_inserts(allocator, inserts)
+            print('{:<8.0%} {:<12} {:>10} {:>12.0f} {:>12.3f}'.format(
+                fill, name, inserts, rate, queries))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
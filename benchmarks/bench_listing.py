@@ -0,0 +1,78 @@
+"""Benchmark listing bookmarks with and without the ORM.
+
+Compares rows per second when building listing json from full Bookmark
+objects (Model.json()) and from plain column rows selected with Core
+(Model.json_select() and Model.row_json()), as the list endpoints do.
+
+    python benchmarks/bench_listing.py --rows 10000 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Point the app at a throwaway database before it is imported
+tmp = tempfile.mkdtemp()
+settings = os.path.join(tmp, 'settings.py')
+with open(settings, 'w') as f:
+    f.write("DATABASE_URI = 'sqlite:///{}'\n".format(
+        os.path.join(tmp, 'bench.db')))
+os.environ['BOOKMARKS_SERVICE_SETTINGS'] = settings
+
+from bookmarks_service.database import db_session, engine, init_db  # noqa
+from bookmarks_service.ids import encode_id  # noqa: E402
+from bookmarks_service.models import Bookmark, User  # noqa: E402
+
+
+def seed(user_id, rows):
+    db_session.add(User('Bench', 'bench{}@example.com'.format(user_id), 'x'))
+    db_session.commit()
+    start = user_id * 10 ** 6
+    engine.execute(Bookmark.__table__.insert(), [
+        {'id': encode_id(start + i), 'url': 'http://example.com/{}'.format(i),
+         'user_id': user_id, 'status': 'verified'} for i in range(rows)])
+
+
+def orm_listing(user_id):
+    return [b.json() for b in Bookmark.query.filter_by(user_id=user_id)]
+
+
+def core_listing(user_id):
+    statement = Bookmark.json_select().where(Bookmark.user_id == user_id)
+    return [Bookmark.row_json(row) for row in db_session.execute(statement)]
+
+
+def rows_per_second(listing, user_id, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rows = len(listing(user_id))
+        elapsed = time.perf_counter() - start
+        # Start each run with an empty identity map
+        db_session.remove()
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, nargs='+',
+                        default=[10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    init_db()
+    print('{:>8} {:>14} {:>14} {:>8}'.format(
+        'rows', 'orm rows/s', 'core rows/s', 'speedup'))
+    for user_id, rows in enumerate(args.rows, 1):
+        seed(user_id, rows)
+        orm = rows_per_second(orm_listing, user_id, args.repeat)
+        core = rows_per_second(core_listing, user_id, args.repeat)
+        print('{:>8} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(
+            rows, orm, core, core / orm))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""Report the query plan of each route's queries.
+
+Seeds a local database, then calls each route with the test client and
+records the statements it makes, with their parameters. Each statement is
+then run through EXPLAIN, so the plans are those of the queries the views
+really make. Background work, like writing click counts, is run the same
+way. Exits with an error if any query has to scan a whole table.
+
+    python benchmarks/query_plans.py
+    python benchmarks/query_plans.py --database-uri postgresql://localhost/bm
+
+A given database must be empty, as it is seeded and then dropped.
+"""
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+parser.add_argument('--database-uri',
+                    help='local database to use instead of a SQLite file')
+# Planners read small tables whole, so seed enough users to be realistic
+parser.add_argument('--users', type=int, default=1000)
+parser.add_argument('--bookmarks', type=int, default=100,
+                    help='bookmarks per user')
+args = parser.parse_args()
+
+# Point the app at the database before it is imported. Duplicate checks are
+# on, so their query is made, and clicks are only written when asked.
+tmp = tempfile.mkdtemp()
+database_uri = args.database_uri or 'sqlite:///{}'.format(
+    os.path.join(tmp, 'plans.db'))
+settings = os.path.join(tmp, 'settings.py')
+with open(settings, 'w') as f:
+    f.write('DATABASE_URI = {!r}\n'.format(database_uri))
+    f.write('DEBUG = False\n')
+    f.write('DEDUPLICATE_BOOKMARKS = True\n')
+    f.write('CLICK_FLUSH_INTERVAL = 3600\n')
+    f.write('RATE_LIMIT_READ_BURST = RATE_LIMIT_CREATE_BURST = 10 ** 9\n')
+os.environ['BOOKMARKS_SERVICE_SETTINGS'] = settings
+
+import bcrypt  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from bookmarks_service import app  # noqa: E402
+from bookmarks_service.analytics import click_counter, compact_stats  # noqa
+from bookmarks_service.cache import caches  # noqa: E402
+from bookmarks_service.database import (Base, db_session, engine,  # noqa
+                                        init_db)
+from bookmarks_service.ids import RandomAllocator  # noqa: E402
+from bookmarks_service.models import (User, SuperUser, Bookmark,  # noqa
+                                      API_Key)
+from bookmarks_service.utils import url_hash  # noqa: E402
+from bookmarks_service.verification import requeue_pending  # noqa: E402
+
+PASSWORD = 'password'
+# Statements that EXPLAIN can report on
+EXPLAINED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+# Routes expected to read a whole table
+EXPECTED_SCANS = {'GET /users'}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Stands in for bookmarked urls, which all exist
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StatementLog(object):
+    # Statements made by this thread while recording, with their parameters.
+    # Background threads, like url verification, are left out.
+    def __init__(self):
+        self.statements = None
+        self.thread = threading.get_ident()
+        event.listen(engine, 'before_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if self.statements is None or threading.get_ident() != self.thread:
+            return
+        if statement.split(None, 1)[0].upper() not in EXPLAINED:
+            return
+        # Plan does not depend on which row of a batch is used
+        if executemany:
+            parameters = parameters[0]
+        self.statements.append((statement, parameters))
+
+    def capture(self, f):
+        self.statements = []
+        try:
+            f()
+            return self.statements
+        finally:
+            self.statements = None
+
+
+def basic_auth(username, password):
+    value = '{}:{}'.format(username, password).encode()
+    return {'Authorization': b'Basic ' + base64.b64encode(value)}
+
+
+def seed():
+    init_db()
+    db_session.add(SuperUser(PASSWORD))
+    password_hash = bcrypt.hashpw(PASSWORD.encode(),
+                                  bcrypt.gensalt()).decode()
+    for i in range(args.users):
+        db_session.add(User('User', 'user{}@example.com'.format(i),
+                            password_hash))
+    db_session.commit()
+    ids = iter(RandomAllocator().allocate(args.users * args.bookmarks))
+    for user_id in range(1, args.users + 1):
+        rows = []
+        for _ in range(args.bookmarks):
+            b_id = next(ids)
+            url = 'http://example.com/{}'.format(b_id)
+            rows.append({'id': b_id, 'url': url, 'url_hash': url_hash(url),
+                         'user_id': user_id, 'status': 'verified',
+                         'hits': 0})
+        engine.execute(Bookmark.__table__.insert(), rows)
+        engine.execute(API_Key.__table__.insert(), [
+            {'id': 'key{}x{}'.format(user_id, i), 'secret': PASSWORD,
+             'user_id': user_id} for i in range(5)])
+    # Give the planner table statistics
+    engine.execute('ANALYZE')
+
+
+def routes(client, stub_url):
+    # Name and function making the queries of each route, or of background
+    # work started by one
+    b_id = db_session.query(Bookmark.id).filter(
+        Bookmark.user_id == 1).first()[0]
+    db_session.remove()
+    api_key = basic_auth('key1x0', PASSWORD)
+    user = basic_auth(1, PASSWORD)
+    super_user = basic_auth(1, PASSWORD)
+
+    def get(path, headers=None):
+        # Read the whole body, as streamed responses query as they are sent
+        return lambda: client.get(path, headers=headers).get_data()
+
+    def post(path, headers, **kwargs):
+        return lambda: client.post(path, headers=headers,
+                                   **kwargs).get_data()
+
+    def next_page():
+        rv = client.get('/bookmarks?limit=10', headers=api_key)
+        client.get(rv.headers['Link'][1:].split('>')[0], headers=api_key)
+
+    def if_none_match():
+        etag = client.get('/bookmarks/' + b_id, headers=api_key).headers[
+            'ETag']
+        client.get('/bookmarks/' + b_id,
+                   headers=dict(api_key, **{'If-None-Match': etag}))
+
+    yield 'GET /<bookmark_id>', get('/' + b_id)
+    yield 'click flush', click_counter.flush
+    yield 'GET /bookmarks', get('/bookmarks', api_key)
+    yield 'GET /bookmarks?after=', next_page
+    yield 'GET /bookmarks?stream=True', get('/bookmarks?stream=True',
+                                            api_key)
+    yield 'POST /bookmarks', post('/bookmarks', api_key,
+                                  data={'url': stub_url + '/new'})
+    yield 'POST /bookmarks (existing)', post(
+        '/bookmarks', api_key,
+        data={'url': 'http://example.com/{}'.format(b_id)})
+    yield 'POST /bookmarks/batch', post(
+        '/bookmarks/batch', api_key,
+        data={'url': [stub_url + '/a', stub_url + '/b']})
+    yield 'GET /bookmarks/export', get('/bookmarks/export', api_key)
+    yield 'POST /bookmarks/import', post(
+        '/bookmarks/import?trust_urls=True', api_key,
+        data='{"url": "http://example.com/imported"}\n')
+    yield 'GET /bookmarks/<bookmark_id>', get('/bookmarks/' + b_id, api_key)
+    yield 'GET /bookmarks/<bookmark_id> (304)', if_none_match
+    yield 'GET /bookmarks/<bookmark_id>/stats', get(
+        '/bookmarks/{}/stats?granularity=day&from=0'.format(b_id), api_key)
+    yield 'stats compaction', compact_stats
+    yield 'pending recovery', requeue_pending
+    yield 'GET /users', get('/users', super_user)
+    yield 'POST /users', post('/users', super_user, data={
+        'name': 'New', 'email': 'new@example.com', 'password': PASSWORD})
+    yield 'GET /users/<user_id>', get('/users/1', super_user)
+    yield 'GET /api_keys', get('/api_keys', user)
+    yield 'POST /api_keys', post('/api_keys', user)
+    yield 'GET /stats', get('/stats', super_user)
+
+
+def explain(statement, parameters):
+    # EXPLAIN a statement as the DBAPI received it
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if engine.dialect.name == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def full_scan(line):
+    # SQLite reports SCAN <table> without an index, PostgreSQL Seq Scan
+    words = line.split()
+    if words[:1] == ['SCAN'] and 'INDEX' not in words:
+        return True
+    return 'Seq Scan' in line
+
+
+def main():
+    print('Seeding {} users with {} bookmarks each...'.format(
+        args.users, args.bookmarks))
+    seed()
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = 'http://127.0.0.1:{}'.format(stub.server_port)
+    client = app.test_client()
+    log = StatementLog()
+    scans = []
+    for name, route in routes(client, stub_url):
+        # Empty caches, so lookups they would save are made and explained
+        for cache in caches.values():
+            cache.clear()
+        statements = log.capture(route)
+        print('\n' + name)
+        seen = set()
+        for statement, parameters in statements:
+            if statement in seen:
+                continue
+            seen.add(statement)
+            print('  ' + ' '.join(statement.split()))
+            for line in explain(statement, parameters):
+                print('    ' + line)
+                if full_scan(line):
+                    scans.append(name)
+    stub.shutdown()
+    db_session.remove()
+    if args.database_uri:
+        Base.metadata.drop_all(bind=engine)
+    scans = [name for name in scans if name not in EXPECTED_SCANS]
+    if scans:
+        print('\nFull table scans in: ' + ', '.join(sorted(set(scans))))
+        return 1
+    print('\nNo unexpected full table scans')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,5 +3,8 @@ from flask import Flask
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_object('bookmarks_service.default_settings')
 app.config.from_pyfile('settings.py', silent=True)
+# Settings file can also be given by environment variable, which is handy
+# for tools like the benchmarks
+app.config.from_envvar('BOOKMARKS_SERVICE_SETTINGS', silent=True)
 
 import bookmarks_service.views
@@ -0,0 +1,236 @@
+import atexit
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import and_, bindparam, func, select, text
+
+from bookmarks_service import app
+from bookmarks_service.database import db_session, engine
+from bookmarks_service.models import (Bookmark, BookmarkStat,
+                                      bump_bookmarks_version)
+
+# Length of stats buckets, in seconds, by granularity
+GRANULARITIES = {'hour': 3600, 'day': 86400}
+
+
+def bucket_start(timestamp, granularity):
+    # Start of the bucket timestamp falls in. Buckets are aligned to UTC.
+    size = GRANULARITIES[granularity]
+    return int(timestamp) // size * size
+
+
+# Adds hits to a stats row, creating it if needed, in one statement. Workers
+# writing the first clicks of the same bucket at once then add to a single
+# row, rather than both inserting it. ON CONFLICT works the same on
+# PostgreSQL and SQLite 3.24+.
+upsert_stats = text(
+    'INSERT INTO {0} (bookmark_id, granularity, bucket, hits) '
+    'VALUES (:b_id, :granularity, :b_bucket, :b_hits) '
+    'ON CONFLICT (bookmark_id, granularity, bucket) '
+    'DO UPDATE SET hits = {0}.hits + excluded.hits'.format(
+        BookmarkStat.__tablename__))
+
+
+def add_stats(conn, granularity, counts):
+    # Add counts, by bookmark id and bucket, to stats rows, as a single
+    # batched upsert. Rows are written in order, so concurrent writers lock
+    # them in the same order.
+    if not counts:
+        return
+    conn.execute(upsert_stats, [
+        {'b_id': b_id, 'granularity': granularity, 'b_bucket': bucket,
+         'b_hits': n}
+        for (b_id, bucket), n in sorted(counts.items())])
+
+
+def roll_up_stats(conn, cutoff):
+    # Move hourly stats before cutoff into daily stats, in the transaction
+    # open on conn. Returns the number of hourly rows removed.
+    table = BookmarkStat.__table__
+    old = and_(table.c.granularity == 'hour', table.c.bucket < cutoff)
+    day = table.c.bucket - table.c.bucket % GRANULARITIES['day']
+    # Every worker process compacts, so lock the rows before reading them.
+    # The update locks them on PostgreSQL, and the whole database on SQLite.
+    # A compaction running at the same time waits for this one to commit,
+    # and then finds the rows gone, instead of counting them twice.
+    conn.execute(table.update().where(old).values(hits=table.c.hits))
+    counts = {(b_id, bucket): n for b_id, bucket, n in conn.execute(
+        select([table.c.bookmark_id, day, func.sum(table.c.hits)])
+        .where(old).group_by(table.c.bookmark_id, day))}
+    add_stats(conn, 'day', counts)
+    return conn.execute(table.delete().where(old)).rowcount
+
+
+def compact_stats(now=None):
+    # Roll hourly stats older than STATS_HOURLY_DAYS up into daily stats, so
+    # the stats table stays small. Returns the number of hourly rows removed.
+    if now is None:
+        now = time.time()
+    cutoff = bucket_start(
+        now - app.config['STATS_HOURLY_DAYS'] * GRANULARITIES['day'], 'day')
+    with engine.begin() as conn:
+        return roll_up_stats(conn, cutoff)
+
+
+def get_stats(bookmark_id, granularity, start, end):
+    # Hits per bucket from start up to end, as (bucket, hits) in order. Daily
+    # stats include hourly rows that have not been compacted yet.
+    table = BookmarkStat.__table__
+    granularities = ['hour', 'day'] if granularity == 'day' else ['hour']
+    rows = db_session.execute(
+        select([table.c.bucket, table.c.hits]).where(and_(
+            table.c.bookmark_id == bookmark_id,
+            table.c.granularity.in_(granularities),
+            table.c.bucket >= bucket_start(start, granularity),
+            table.c.bucket < end)))
+    hits = Counter()
+    for bucket, n in rows:
+        hits[bucket_start(bucket, granularity)] += n
+    return sorted(hits.items())
+
+
+class ClickCounter(object):
+    # Counts short link clicks in memory, and adds them to bookmark hit
+    # counts and hourly stats in batches. A background thread flushes counts
+    # every flush_interval seconds, or as soon as flush_size clicks are
+    # waiting, so a crash loses at most that many clicks. Counts that could
+    # not be written are kept for the next flush, up to max_pending clicks,
+    # after which new clicks are dropped. The same thread compacts stats
+    # every compact_interval seconds.
+    def __init__(self, flush_size, flush_interval, max_pending,
+                 compact_interval):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.compact_interval = compact_interval
+        self.flushed = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+        self._counts = Counter()
+        self._pending = 0
+        self._lock = threading.Lock()
+        # Serializes flushes, so counts are never written twice
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __repr__(self):
+        return '<ClickCounter %r>' % (self._pending)
+
+    def record(self, bookmark_id):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self.dropped += 1
+                return
+            self._counts[bookmark_id, bucket_start(time.time(), 'hour')] += 1
+            self._pending += 1
+            full = self._pending >= self.flush_size
+            # Start flushing thread on first click
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='click-flush', daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        next_compaction = time.monotonic()
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+            # Leave compaction for later when shutting down
+            if (not self._stopped.is_set() and
+                    time.monotonic() >= next_compaction):
+                next_compaction = time.monotonic() + self.compact_interval
+                try:
+                    compact_stats()
+                except Exception:
+                    app.logger.exception('Could not compact bookmark stats')
+
+    def take(self):
+        # Take all counts waiting to be written
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._pending = 0
+        return counts
+
+    def restore(self, counts):
+        # Put back counts that could not be written, as far as they fit
+        with self._lock:
+            for key, n in counts.items():
+                n_kept = min(n, self.max_pending - self._pending)
+                if n_kept > 0:
+                    self._counts[key] += n_kept
+                    self._pending += n_kept
+                self.dropped += n - max(n_kept, 0)
+
+    def flush(self):
+        # Write waiting counts in a single transaction. Returns the number of
+        # clicks written.
+        with self._flush_lock:
+            counts = self.take()
+            if not counts:
+                return 0
+            try:
+                with engine.begin() as conn:
+                    self.write(conn, counts)
+            except Exception:
+                app.logger.exception('Could not flush %s click counts',
+                                     len(counts))
+                self.failed_flushes += 1
+                self.restore(counts)
+                return 0
+            n = sum(counts.values())
+            self.flushed += n
+            return n
+
+    def write(self, conn, counts):
+        # Add counts, by bookmark id and hour, to bookmark hit counts as one
+        # batched update, and to hourly stats
+        hits = Counter()
+        for (b_id, _), n in counts.items():
+            hits[b_id] += n
+        table = Bookmark.__table__
+        update = table.update().where(
+            table.c.id == bindparam('b_id')).values(
+                hits=table.c.hits + bindparam('b_hits'))
+        conn.execute(update, [{'b_id': b_id, 'b_hits': n}
+                              for b_id, n in sorted(hits.items())])
+        # Hit counts are part of bookmark json, so ETags must change
+        conn.execute(bump_bookmarks_version(select([table.c.user_id]).where(
+            table.c.id.in_(list(hits)))))
+        add_stats(conn, 'hour', counts)
+
+    def close(self):
+        # Stop flushing thread and write any remaining counts
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(self.flush_interval)
+        self.flush()
+
+    def clear(self):
+        self.take()
+        self.flushed = 0
+        self.dropped = 0
+        self.failed_flushes = 0
+
+    def stats(self):
+        return {
+            'pending': self._pending,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'failed_flushes': self.failed_flushes
+        }
+
+
+click_counter = ClickCounter(
+    flush_size=app.config['CLICK_FLUSH_SIZE'],
+    flush_interval=app.config['CLICK_FLUSH_INTERVAL'],
+    max_pending=app.config['CLICK_MAX_PENDING'],
+    compact_interval=app.config['STATS_COMPACT_INTERVAL'])
+# Write remaining counts when the process exits
+atexit.register(click_counter.close)
@@ -0,0 +1,103 @@
+import hashlib
+import hmac
+from collections import namedtuple
+
+import bcrypt
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+from bookmarks_service import app
+from bookmarks_service.cache import LRUCache
+from bookmarks_service.metrics import bcrypt_seconds
+from bookmarks_service.models import User, API_Key
+
+# Copies of an api key and its user, safe to share between requests
+APIKeySnapshot = namedtuple('APIKeySnapshot', ['id', 'user_id'])
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'name', 'email'])
+
+# Cache of successful password checks. Keys hold a keyed hash of the
+# password, never the password itself, and values the password hash it was
+# checked against.
+credential_cache = LRUCache(
+    'credentials',
+    maxsize=app.config['CREDENTIAL_CACHE_SIZE'],
+    ttl=app.config['CREDENTIAL_CACHE_TTL'])
+# Cache of api key id to a keyed hash of its secret, and snapshots of the
+# api key and its user
+api_key_cache = LRUCache(
+    'api_keys',
+    maxsize=app.config['API_KEY_CACHE_SIZE'],
+    ttl=app.config['API_KEY_CACHE_TTL'])
+
+
+def keyed_digest(value):
+    # Keyed hash of a password or secret, so a cache dump can not be brute
+    # forced without the secret key
+    key = app.config['SECRET_KEY']
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return hmac.new(key, value.encode('utf-8'), hashlib.sha256).digest()
+
+
+def check_password(kind, id, password, password_hash):
+    # Check password against password_hash, skipping bcrypt when the same
+    # password was recently checked. Kind keeps user and superuser ids apart.
+    key = (kind, id, keyed_digest(password))
+    cached_hash = credential_cache.get(key)
+    # Cached check only counts for the same password hash, so changing a
+    # password invalidates it
+    if cached_hash is not None and hmac.compare_digest(
+            cached_hash, password_hash):
+        return True
+    with bcrypt_seconds.time():
+        matches = bcrypt.checkpw(password.encode('utf-8'),
+                                 password_hash.encode('utf-8'))
+    if matches:
+        credential_cache.set(key, password_hash)
+        return True
+    return False
+
+
+def authenticate_api_key(api_key_id, secret):
+    # Returns api key and user snapshots if secret matches, or None
+    entry = api_key_cache.get(api_key_id)
+    if entry is None:
+        # Load api key and its user in a single query
+        api_key = API_Key.query.options(
+            joinedload(API_Key.user)).get(api_key_id)
+        if not api_key:
+            return None
+        user = api_key.user
+        entry = (
+            keyed_digest(api_key.secret),
+            APIKeySnapshot(api_key.id, api_key.user_id),
+            UserSnapshot(user.id, user.name, user.email)
+        )
+        api_key_cache.set(api_key_id, entry)
+    digest, api_key, user = entry
+    if not hmac.compare_digest(digest, keyed_digest(secret)):
+        return None
+    return api_key, user
+
+
+def invalidate_api_key(api_key_id):
+    api_key_cache.delete(api_key_id)
+
+
+def invalidate_user(user_id):
+    # Drop all cached api keys belonging to user
+    api_key_cache.delete_matching(lambda entry: entry[2].id == user_id)
+
+
+# Invalidate cached api keys when they, or their user, change in this
+# process. Other processes rely on API_KEY_CACHE_TTL.
+@event.listens_for(API_Key, 'after_update')
+@event.listens_for(API_Key, 'after_delete')
+def api_key_changed(mapper, connection, target):
+    invalidate_api_key(target.id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, target):
+    invalidate_user(target.id)
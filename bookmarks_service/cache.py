@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+
+# All caches created in the app, by name. Used to report cache stats.
+caches = {}
+
+
+class LRUCache(object):
+    # Bounded, thread safe cache. Least recently used entries are evicted
+    # once maxsize is reached, and entries expire after ttl seconds.
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Register cache so its stats can be reported
+        caches[name] = self
+
+    def __repr__(self):
+        return '<LRUCache %r>' % (self.name)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            # Drop expired entry
+            if entry is not None and entry[1] <= time.monotonic():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            # Mark as most recently used
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        # A maxsize of 0 disables the cache
+        if self.maxsize <= 0:
+            return
+        # Entries can be given their own ttl
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            # Evict least recently used entries
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        # Delete all entries whose value matches predicate
+        with self._lock:
+            for key in [key for key, (value, _) in self._data.items()
+                        if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl
+        }
@@ -0,0 +1,113 @@
+import zlib
+
+from flask import request
+
+from bookmarks_service import app
+
+# Brotli compresses json noticeably better than gzip, so offer it when it is
+# installed. See COMPRESS_ENCODINGS in settings.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class GzipCompressor(object):
+    def __init__(self):
+        # wbits of 31 writes a gzip header and trailer
+        self._compressor = zlib.compressobj(
+            app.config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        # Output everything compressed so far, without ending the stream
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor(object):
+    def __init__(self):
+        self._compressor = brotli.Compressor(
+            quality=app.config['COMPRESS_BROTLI_LEVEL'])
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+# Compressor for each content coding
+compressors = {'gzip': GzipCompressor}
+if brotli is not None:
+    compressors['br'] = BrotliCompressor
+
+
+def choose_encoding():
+    # Best encoding the client accepts, in order of COMPRESS_ENCODINGS when
+    # it accepts several equally. None when it accepts none of them.
+    available = [encoding for encoding in app.config['COMPRESS_ENCODINGS']
+                 if encoding in compressors]
+    return request.accept_encodings.best_match(available)
+
+
+def etag_variants(etag):
+    # ETags a response could have been sent with, as compressed responses
+    # get the encoding added to their ETag
+    return [etag] + ['{}-{}'.format(etag, encoding)
+                     for encoding in compressors]
+
+
+def compress_stream(chunks, compressor):
+    # Compress each chunk and send it on right away, so clients still get
+    # streamed responses as they are written
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield compressor.compress(chunk) + compressor.flush()
+        yield compressor.finish()
+    finally:
+        # Closes the database cursor and request context of a streamed
+        # response
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    # Compress a json response with the best encoding the client accepts.
+    # Streamed responses are compressed as they are sent. Others are only
+    # compressed from COMPRESS_MIN_SIZE bytes, as small bodies barely shrink.
+    if response.mimetype not in app.config['COMPRESS_MIMETYPES']:
+        return response
+    # Whether the body is compressed depends on Accept-Encoding, so caches
+    # must keep a copy for each
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or request.method == 'HEAD' or
+            'Content-Encoding' in response.headers):
+        return response
+    if (not response.is_streamed and
+            len(response.get_data()) < app.config['COMPRESS_MIN_SIZE']):
+        return response
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+    compressor = compressors[encoding]()
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) +
+                          compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    # A compressed body is a different representation, so needs its own ETag
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag('{}-{}'.format(etag, encoding), weak)
+    return response
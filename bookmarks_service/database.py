@@ -1,19 +1,137 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 
 from bookmarks_service import app
 
-engine = create_engine(app.config['DATABASE_URI'], convert_unicode=True)
+
+class InstrumentedQueuePool(QueuePool):
+    # QueuePool that also records how long checkouts wait for a connection,
+    # and how many give up waiting
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            wait = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        return {
+            'size': self.size(),
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': self.overflow(),
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_time': self.wait_time,
+            'max_wait': self.max_wait
+        }
+
+
+def engine_options(uri):
+    options = {
+        'convert_unicode': True,
+        'pool_pre_ping': app.config['DATABASE_POOL_PRE_PING'],
+        'pool_recycle': app.config['DATABASE_POOL_RECYCLE']
+    }
+    # SQLite has its own pool classes, which can not be sized
+    if not uri.startswith('sqlite'):
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=app.config['DATABASE_POOL_SIZE'],
+            max_overflow=app.config['DATABASE_MAX_OVERFLOW'],
+            pool_timeout=app.config['DATABASE_POOL_TIMEOUT'])
+    return options
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {'status': pool.status()}
+
+
+engine = create_engine(app.config['DATABASE_URI'],
+                       **engine_options(app.config['DATABASE_URI']))
+# Optional read replica. Sessions in read only mode read from it.
+replica_engine = None
+if app.config['DATABASE_REPLICA_URI']:
+    replica_engine = create_engine(
+        app.config['DATABASE_REPLICA_URI'],
+        **engine_options(app.config['DATABASE_REPLICA_URI']))
+
+
+class RoutingSession(Session):
+    # Sends queries to the replica while in read only mode, and everything
+    # else, including all writes, to the primary
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (replica_engine is not None and self.info.get('read_only') and
+                not self._flushing):
+            return replica_engine
+        return engine
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def leave_read_only(session, flush_context):
+    # Once session has written, it reads its own writes from the primary
+    session.info['read_only'] = False
+
 
 db_session = scoped_session(sessionmaker(autocommit=False,
                                          autoflush=False,
+                                         class_=RoutingSession,
                                          bind=engine))
 
+
+def replica_pool_stats():
+    if replica_engine is None:
+        return None
+    return pool_stats(replica_engine)
+
+
+def reading_replica():
+    return (replica_engine is not None and
+            bool(db_session().info.get('read_only')))
+
+
+@contextmanager
+def read_only(value=True):
+    # Set whether current session reads from the replica, for a while
+    info = db_session().info
+    previous = info.get('read_only', False)
+    info['read_only'] = value
+    try:
+        yield
+    finally:
+        info['read_only'] = previous
+
+
 Base = declarative_base()
 Base.query = db_session.query_property()
 
 
 def init_db():
-    import bookmarks_service.models
-    Base.metadata.create_all(bind=engine)
+    # Create schema, or bring an existing one up to date
+    from bookmarks_service.migrations import migrate
+    migrate()
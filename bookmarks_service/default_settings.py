@@ -16,6 +16,142 @@ SECRET_KEY = 'development key'  # TODO: Enter secret key
 TESTING = False
 # Request timeout limit, in seconds
 TIMEOUT = 5
+# Number of hosts to keep open connections to when verifying urls
+VERIFY_POOL_HOSTS = 100
+# Max number of connections kept open to a single host when verifying urls
+VERIFY_POOL_PER_HOST = 4
+# Max bytes read from a response body when verifying urls. Small bodies are
+# read so the connection can be reused, larger ones are never downloaded
+VERIFY_MAX_BYTES = 65536
+# Return a user's existing bookmark, instead of creating another, when they
+# bookmark the same url again
+DEDUPLICATE_BOOKMARKS = False
+# Max number of url verification results cached
+VERIFY_CACHE_SIZE = 10000
+# Seconds a successful url verification is cached
+VERIFY_CACHE_TTL = 3600
+# Seconds a failed url verification is cached
+VERIFY_NEGATIVE_CACHE_TTL = 60
+# Max number of urls verified at the same time by batch bookmark creation
+VERIFY_WORKERS = 10
+# Max number of async mode bookmarks verified at the same time
+VERIFY_BACKGROUND_WORKERS = 10
+# Seconds an async mode bookmark can stay pending before it is queued for
+# verification again, in case the process verifying it died. Keep this well
+# above TIMEOUT, as verifications can wait for a free worker first
+VERIFY_PENDING_TIMEOUT = 60
+# Max number of urls accepted by a single batch bookmark creation
+BATCH_MAX_URLS = 1000
+# Number of lines of a bookmark import verified and inserted at a time
+IMPORT_BATCH_SIZE = 500
+# Max number of failed lines listed in an import's summary. Failures beyond
+# this are still counted
+IMPORT_MAX_ERRORS = 100
+# Longest line, in bytes, accepted in a bookmark import
+IMPORT_MAX_LINE_LENGTH = 65536
+# Max number of successful password checks cached, so repeated requests
+# from users and superusers skip bcrypt
+CREDENTIAL_CACHE_SIZE = 1000
+# Seconds a successful password check is cached
+CREDENTIAL_CACHE_TTL = 60
+# Max number of api keys cached, with their users, for authentication
+API_KEY_CACHE_SIZE = 10000
+# Seconds an api key is cached. Changes made by other processes can take
+# this long to be seen
+API_KEY_CACHE_TTL = 60
+# How bookmark ids are allocated. 'random' picks random ids and checks that
+# they are not taken. 'permutation' maps a counter through a keyed
+# permutation, so ids need no lookup. Use 'permutation' for new databases,
+# as its ids could collide with ids already picked by 'random'
+BOOKMARK_ID_ALLOCATOR = 'random'
+# Key for the 'permutation' id allocator. Changing it once ids have been
+# allocated can cause duplicate ids
+BOOKMARK_ID_KEY = 'development id key'  # TODO: Enter id key
+# Number of ids each process reserves at a time with 'permutation'
+BOOKMARK_ID_BLOCK_SIZE = 1000
+# Status code used when redirecting short links (301 or 302). 302 keeps
+# browsers from caching the redirect, so every click reaches the service
+REDIRECT_CODE = 302
+# Max number of bookmark urls held in the short link redirect cache
+REDIRECT_CACHE_SIZE = 10000
+# Seconds a bookmark url stays in the redirect cache
+REDIRECT_CACHE_TTL = 300
+# Default number of items per page when listing bookmarks and api keys
+PAGE_SIZE = 100
+# Largest page size a client may request with the limit argument
+MAX_PAGE_SIZE = 1000
+# Number of rows fetched and written at a time by streamed responses
+STREAM_BATCH_SIZE = 500
+# Short link clicks are counted in memory and written in batches. Counts
+# are written once this many clicks are waiting, so at most this many are
+# lost if the process crashes
+CLICK_FLUSH_SIZE = 1000
+# Seconds between writes of waiting click counts
+CLICK_FLUSH_INTERVAL = 10
+# Max number of clicks held in memory while the database cannot be written
+# to. Clicks beyond this are dropped
+CLICK_MAX_PENDING = 100000
+# Api key rate limits, as token buckets. Each api key can make BURST
+# requests at once, and then RATE requests per second. Creating bookmarks
+# has its own, smaller budget, as each one waits on verifying a url
+RATE_LIMIT_READ_RATE = 10
+RATE_LIMIT_READ_BURST = 100
+RATE_LIMIT_CREATE_RATE = 1
+RATE_LIMIT_CREATE_BURST = 20
+# SQLite file holding rate limit state, shared by all processes on the host.
+# Set this when running several worker processes, otherwise each process
+# keeps its own limits in memory
+RATE_LIMIT_FILE = None
+# Max number of api keys whose rate limits are kept in memory
+RATE_LIMIT_MAX_KEYS = 100000
+# SQLite file where each process stores its metrics, so /metrics reports
+# totals for all processes on the host. Set this when running several
+# worker processes, otherwise /metrics only covers the process it reaches
+METRICS_FILE = None
+# Seconds between each process storing its metrics in METRICS_FILE
+METRICS_SNAPSHOT_INTERVAL = 15
+# Max number of database queries a request should make, unless its view
+# sets its own with query_budget. In debug mode, requests over budget log a
+# warning with the queries they repeated
+QUERY_BUDGET = 10
+# Days hourly click stats are kept, before being rolled up into daily stats
+STATS_HOURLY_DAYS = 7
+# Seconds between roll ups of old hourly click stats
+STATS_COMPACT_INTERVAL = 3600
+# Json encoder used for responses. 'orjson' is much faster, 'stdlib' needs
+# nothing installed, and 'auto' uses orjson when it is installed
+JSON_BACKEND = 'auto'
+# Content codings used to compress json responses, in order of preference
+# when a client accepts several. 'br' is only used when brotli is installed
+COMPRESS_ENCODINGS = ['br', 'gzip']
+# Mimetypes of responses that are compressed
+COMPRESS_MIMETYPES = ['application/json', 'application/x-ndjson']
+# Smallest response body, in bytes, that is compressed. Streamed responses
+# are always compressed
+COMPRESS_MIN_SIZE = 1024
+# Compression levels. Gzip goes from 1 (fastest) to 9 (smallest), brotli
+# from 0 to 11. Higher levels cost more CPU on every response
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_LEVEL = 4
+
+# Optional read replica of DATABASE_URI. When set, GET requests and
+# authentication read from the replica
+DATABASE_REPLICA_URI = None
+# Seconds after a client writes during which its reads go to the primary,
+# so it sees its own writes despite replication lag
+REPLICA_STICKY_SECONDS = 5
+# Number of database connections kept open in the pool. Pool settings are
+# not used with SQLite
+DATABASE_POOL_SIZE = 5
+# Number of connections that can be opened beyond DATABASE_POOL_SIZE when
+# the pool is busy
+DATABASE_MAX_OVERFLOW = 10
+# Seconds to wait for a free connection before giving up
+DATABASE_POOL_TIMEOUT = 30
+# Seconds after which a connection is replaced, or -1 to never replace
+DATABASE_POOL_RECYCLE = -1
+# Check that connections are alive before using them
+DATABASE_POOL_PRE_PING = False
 
 if app_env == 'production':
     DATABASE_URI = ''  # TODO: Enter your production database
@@ -29,3 +165,5 @@ if app_env == 'testing':
     DATABASE_URI = ''  # TODO: Enter your test database
     TESTING = True  # Allows testing to run
     TIMEOUT = 1  # Sets timeout to 1 second for testing
+    CLICK_FLUSH_INTERVAL = 3600  # Tests flush click counts themselves
+    VERIFY_PENDING_TIMEOUT = 3600  # Tests queue pending bookmarks themselves
@@ -0,0 +1,155 @@
+import hashlib
+import hmac
+import random
+import string
+import threading
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from bookmarks_service import app
+from bookmarks_service.database import db_session, engine
+from bookmarks_service.models import Bookmark, IdCounter
+
+# Bookmark ids are 6 lowercase alphanumeric characters
+ALPHABET = string.digits + string.ascii_lowercase
+ID_LENGTH = 6
+ID_SPACE = len(ALPHABET) ** ID_LENGTH
+# Ids that would clash with other routes under /bookmarks/
+RESERVED_IDS = {'export', 'import'}
+
+
+def encode_id(n, length=ID_LENGTH):
+    # Encode number in base 36, padded to length characters
+    chars = []
+    for _ in range(length):
+        n, i = divmod(n, len(ALPHABET))
+        chars.append(ALPHABET[i])
+    return ''.join(reversed(chars))
+
+
+class RandomAllocator(object):
+    # Random ids, checked against existing bookmarks. Needs a query for each
+    # batch of ids, and more of them as the id space fills up. Shorter ids
+    # than ID_LENGTH are only for benchmarks, which fill a smaller id space.
+    def __init__(self, length=ID_LENGTH):
+        self.length = length
+
+    def allocate(self, n):
+        ids = set()
+        while len(ids) < n:
+            candidates = {''.join(random.choice(ALPHABET)
+                                  for _ in range(self.length))
+                          for _ in range(n - len(ids))} - ids - RESERVED_IDS
+            # Check that ids do not exist
+            taken = {b_id for b_id, in db_session.query(Bookmark.id).filter(
+                Bookmark.id.in_(list(candidates)))}
+            ids |= candidates - taken
+        return list(ids)
+
+
+class PermutationAllocator(object):
+    # Ids from a counter, mapped through a keyed permutation of the id space
+    # so they are unique but do not look sequential. Each process reserves
+    # counter values from the database in blocks, so most ids need no query
+    # at all. Shorter ids than ID_LENGTH are only for benchmarks.
+    rounds = 4
+
+    def __init__(self, key, block_size, name='bookmarks', length=ID_LENGTH):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        self.key = key
+        self.block_size = block_size
+        self.name = name
+        self.length = length
+        self.space = len(ALPHABET) ** length
+        # Feistel halves are wide enough to cover the id space, which is 16
+        # bits each for 6 character ids
+        self.half_bits = ((self.space - 1).bit_length() + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self._next = self._end = 0
+        self._lock = threading.Lock()
+
+    def allocate(self, n):
+        ids = []
+        with self._lock:
+            while len(ids) < n:
+                if self._next >= self._end:
+                    self._next, self._end = self.reserve(self.block_size)
+                b_id = encode_id(self.permute(self._next), self.length)
+                self._next += 1
+                if b_id not in RESERVED_IDS:
+                    ids.append(b_id)
+        return ids
+
+    def reserve(self, size):
+        # Reserve the next size counter values. Runs in its own transaction
+        # on the primary database, and the update locks the counter row, so
+        # no two processes get the same block.
+        counters = IdCounter.__table__
+        where = counters.c.name == self.name
+        for _ in range(2):
+            try:
+                with engine.begin() as conn:
+                    result = conn.execute(
+                        counters.update().where(where).values(
+                            next_value=counters.c.next_value + size))
+                    if result.rowcount:
+                        end = conn.execute(
+                            select([counters.c.next_value]).where(where)
+                        ).scalar()
+                    else:
+                        # First block for this counter
+                        end = size
+                        conn.execute(counters.insert().values(
+                            name=self.name, next_value=end))
+                break
+            # Another process created the counter first, so try again
+            except IntegrityError:
+                continue
+        else:
+            raise RuntimeError('Could not reserve ids from counter {!r}'
+                               .format(self.name))
+        if end - size >= self.space:
+            raise RuntimeError('Bookmark id space is exhausted')
+        # The last block can run past the end of the id space
+        return end - size, min(end, self.space)
+
+    def round(self, i, half):
+        digest = hmac.new(self.key, bytes([i]) + half.to_bytes(2, 'big'),
+                          hashlib.sha256).digest()
+        return int.from_bytes(digest[:2], 'big') & self.half_mask
+
+    def feistel(self, n):
+        # Keyed permutation of numbers of twice half_bits bits
+        left, right = n >> self.half_bits, n & self.half_mask
+        for i in range(self.rounds):
+            left, right = right, left ^ self.round(i, right)
+        return (left << self.half_bits) | right
+
+    def permute(self, n):
+        # The id space is smaller than the feistel's, so keep permuting until
+        # the result falls inside it. This is still a permutation of the id
+        # space.
+        n = self.feistel(n)
+        while n >= self.space:
+            n = self.feistel(n)
+        return n
+
+
+def create_allocator(config):
+    name = config['BOOKMARK_ID_ALLOCATOR']
+    if name == 'random':
+        return RandomAllocator()
+    if name == 'permutation':
+        return PermutationAllocator(config['BOOKMARK_ID_KEY'],
+                                    config['BOOKMARK_ID_BLOCK_SIZE'])
+    raise ValueError('Unknown BOOKMARK_ID_ALLOCATOR {!r}'.format(name))
+
+
+allocator = create_allocator(app.config)
+
+
+def new_bookmark_ids(n):
+    # Allocate n unused bookmark ids
+    return allocator.allocate(n)
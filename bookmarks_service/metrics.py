@@ -0,0 +1,321 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from bookmarks_service import app
+from bookmarks_service.database import engine, replica_engine
+
+# All metrics created in the app, by name
+metrics = {}
+
+# Histogram buckets, in seconds, suited to request and query latencies
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+    # Values of a metric by labels, which are kept as a sorted tuple of
+    # (name, value) pairs
+    kind = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+        # Register metric so it is exported
+        metrics[name] = self
+
+    def __repr__(self):
+        return '<{} {!r}>'.format(type(self).__name__, self.name)
+
+    def snapshot(self):
+        # Values as json, for sharing with other processes
+        with self._lock:
+            return [[list(labels), value]
+                    for labels, value in self.values.items()]
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    # Values are a count for each bucket (not cumulative), then the sum and
+    # count of all observations
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+
+def snapshot():
+    # Values of every metric in this process
+    return {name: metric.snapshot() for name, metric in metrics.items()}
+
+
+def merge(snapshots):
+    # Add up snapshots from several processes. Returns values by metric
+    # name and labels.
+    totals = {name: {} for name in metrics}
+    for data in snapshots:
+        for name, values in data.items():
+            if name not in totals:
+                continue
+            for labels, value in values:
+                key = tuple(tuple(pair) for pair in labels)
+                total = totals[name].get(key)
+                if total is None:
+                    totals[name][key] = value
+                elif isinstance(value, list):
+                    totals[name][key] = [a + b for a, b in zip(total, value)]
+                else:
+                    totals[name][key] = total + value
+    return totals
+
+
+def as_snapshot(totals):
+    # Totals from merge, in the form of a snapshot
+    return {name: [[[list(pair) for pair in labels], value]
+                   for labels, value in values.items()]
+            for name, values in totals.items()}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+def format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(totals):
+    # Metrics in the Prometheus text exposition format
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append('# HELP {} {}'.format(name, metric.help))
+        lines.append('# TYPE {} {}'.format(name, metric.kind))
+        for labels, value in sorted(totals.get(name, {}).items()):
+            if metric.kind == 'counter':
+                lines.append('{}{} {}'.format(
+                    name, format_labels(labels), format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                name, format_labels(labels + (('le', '+Inf'),)), value[-1]))
+            lines.append('{}_sum{} {}'.format(
+                name, format_labels(labels), format_value(value[-2])))
+            lines.append('{}_count{} {}'.format(
+                name, format_labels(labels), value[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+class SnapshotStore(object):
+    # SQLite file holding the latest metrics snapshot of each process on the
+    # host, so any process can report totals for all of them. Snapshots of
+    # processes that have exited are kept, so counters never go down. Pids
+    # are reused, so each process has its own key. When a process finds a
+    # snapshot of an earlier process with its pid, it adds it to the
+    # 'retired' snapshot, which totals all such processes.
+    def __init__(self, path, interval, timeout=5):
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._thread_pid = None
+        self._process = None
+        conn = self.connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS metric_snapshots ('
+            'process TEXT PRIMARY KEY, pid INTEGER, updated REAL NOT NULL, '
+            'data TEXT NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_metric_snapshots_pid '
+                     'ON metric_snapshots (pid)')
+
+    def connection(self):
+        # One connection per thread, and a new one after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def process(self):
+        # Pid and key of this process, with a new key after a fork
+        with self._lock:
+            if self._process is None or self._process[0] != os.getpid():
+                self._process = (os.getpid(), uuid.uuid4().hex)
+            return self._process
+
+    def start(self):
+        # Write snapshots every interval seconds from a background thread.
+        # Threads do not survive a fork, so each process starts its own.
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, name='metrics-snapshot',
+                         daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception:
+                app.logger.exception('Could not write metrics snapshot')
+
+    def write(self):
+        pid, process = self.process()
+        conn = self.connection()
+        # Lock the database for writing before reading snapshots
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            old = conn.execute(
+                'SELECT data FROM metric_snapshots '
+                'WHERE pid = ? AND process != ?', (pid, process)).fetchall()
+            if old:
+                retired = conn.execute(
+                    "SELECT data FROM metric_snapshots "
+                    "WHERE process = 'retired'").fetchall()
+                data = as_snapshot(merge(
+                    json.loads(row) for row, in retired + old))
+                conn.execute(
+                    "INSERT OR REPLACE INTO metric_snapshots "
+                    "VALUES ('retired', NULL, ?, ?)",
+                    (time.time(), json.dumps(data)))
+                conn.execute(
+                    'DELETE FROM metric_snapshots '
+                    'WHERE pid = ? AND process != ?', (pid, process))
+            conn.execute(
+                'INSERT OR REPLACE INTO metric_snapshots VALUES (?, ?, ?, ?)',
+                (process, pid, time.time(), json.dumps(snapshot())))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def read(self):
+        # Snapshots of all processes, with this process's current values
+        self.write()
+        return [json.loads(data) for data, in self.connection().execute(
+            'SELECT data FROM metric_snapshots')]
+
+
+snapshot_store = None
+if app.config['METRICS_FILE']:
+    snapshot_store = SnapshotStore(app.config['METRICS_FILE'],
+                                   app.config['METRICS_SNAPSHOT_INTERVAL'])
+    # Write final values when the process exits
+    atexit.register(snapshot_store.write)
+
+
+def start_snapshots():
+    # Called on every request, so each worker process shares its metrics
+    if snapshot_store is not None:
+        snapshot_store.start()
+
+
+def export():
+    # Totals across processes when snapshots are shared, in text format
+    if snapshot_store is not None:
+        return render(merge(snapshot_store.read()))
+    return render(merge([snapshot()]))
+
+
+request_seconds = Histogram(
+    'http_request_duration_seconds',
+    'Time spent handling requests, by route and method')
+requests_total = Counter(
+    'http_requests_total',
+    'Requests handled, by route, method and status code')
+bcrypt_seconds = Histogram(
+    'bcrypt_check_duration_seconds',
+    'Time spent checking passwords with bcrypt')
+verification_seconds = Histogram(
+    'url_verification_duration_seconds',
+    'Time spent verifying urls, by outcome')
+verifications_total = Counter(
+    'url_verifications_total',
+    'Urls verified, by outcome (ok or the class of error)')
+query_seconds = Histogram(
+    'db_query_duration_seconds',
+    'Time spent on database queries, by database and operation')
+queries_total = Counter(
+    'db_queries_total',
+    'Database queries made, by database and operation')
+
+
+def instrument_engine(engine, database):
+    # Record count and duration of every query made through engine
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = time.perf_counter() - conn.info['query_start'].pop()
+        operation = statement.split(None, 1)[0].upper() if statement else ''
+        query_seconds.observe(elapsed, database=database,
+                              operation=operation)
+        queries_total.inc(database=database, operation=operation)
+
+
+instrument_engine(engine, 'primary')
+if replica_engine is not None:
+    instrument_engine(replica_engine, 'replica')
@@ -0,0 +1,155 @@
+from sqlalchemy import bindparam, inspect, select
+
+from bookmarks_service.database import Base, engine
+from bookmarks_service.models import (Bookmark, BookmarkStat, API_Key,
+                                      IdCounter, SchemaVersion)
+from bookmarks_service.utils import url_hash
+
+# Schema changes, in order. A database's version is the number of these that
+# have been applied to it.
+migrations = []
+
+
+def migration(f):
+    migrations.append(f)
+    return f
+
+
+def add_column(conn, table, name, ddl):
+    # Add column unless it already exists
+    columns = [c['name'] for c in inspect(conn).get_columns(table)]
+    if name not in columns:
+        conn.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table, name, ddl))
+
+
+def add_index(conn, model, name):
+    # Create one of the model's indexes unless it already exists
+    indexes = [i['name'] for i in inspect(conn).get_indexes(
+        model.__tablename__)]
+    if name not in indexes:
+        index, = [i for i in model.__table__.indexes if i.name == name]
+        index.create(conn)
+
+
+@migration
+def add_bookmark_status(conn):
+    add_column(conn, 'bookmarks', 'status',
+               "VARCHAR(8) NOT NULL DEFAULT 'verified'")
+    add_column(conn, 'bookmarks', 'error', 'TEXT')
+
+
+@migration
+def add_id_counters(conn):
+    IdCounter.__table__.create(conn, checkfirst=True)
+
+
+@migration
+def add_user_indexes(conn):
+    add_index(conn, Bookmark, 'ix_bookmarks_user_id_id')
+    add_index(conn, API_Key, 'ix_api_keys_user_id_id')
+
+
+@migration
+def add_bookmark_url_hash(conn):
+    add_column(conn, 'bookmarks', 'url_hash', 'VARCHAR(64)')
+    add_index(conn, Bookmark, 'ix_bookmarks_user_id_url_hash')
+    # Fill in hashes for existing bookmarks, a batch at a time
+    table = Bookmark.__table__
+    update = table.update().where(table.c.id == bindparam('b_id')).values(
+        url_hash=bindparam('b_url_hash'))
+    while True:
+        rows = conn.execute(select([table.c.id, table.c.url]).where(
+            table.c.url_hash.is_(None)).limit(1000)).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [{'b_id': b_id, 'b_url_hash': url_hash(url)}
+                              for b_id, url in rows])
+
+
+@migration
+def add_bookmark_hits(conn):
+    add_column(conn, 'bookmarks', 'hits', 'BIGINT NOT NULL DEFAULT 0')
+
+
+@migration
+def add_bookmark_stats(conn):
+    BookmarkStat.__table__.create(conn, checkfirst=True)
+
+
+@migration
+def add_bookmarks_version(conn):
+    add_column(conn, 'users', 'bookmarks_version',
+               'BIGINT NOT NULL DEFAULT 0')
+
+
+@migration
+def hash_url_fragments(conn):
+    # Url hashes now include the fragment, so rehash urls that have one
+    table = Bookmark.__table__
+    update = table.update().where(table.c.id == bindparam('b_id')).values(
+        url_hash=bindparam('b_url_hash'))
+    last_id = ''
+    while True:
+        rows = conn.execute(select([table.c.id, table.c.url]).where(
+            table.c.url.contains('#') & (table.c.id > last_id)).order_by(
+                table.c.id).limit(1000)).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [{'b_id': b_id, 'b_url_hash': url_hash(url)}
+                              for b_id, url in rows])
+        last_id = rows[-1][0]
+
+
+@migration
+def add_bookmark_pending_since(conn):
+    add_column(conn, 'bookmarks', 'pending_since', 'BIGINT')
+    add_column(conn, 'bookmarks', 'follow_redirects', 'BOOLEAN')
+    add_index(conn, Bookmark, 'ix_bookmarks_pending_since')
+    # Bookmarks already pending are queued again right away. Whether they
+    # followed redirects is not known, so they do not.
+    table = Bookmark.__table__
+    conn.execute(table.update().where(table.c.status == 'pending').values(
+        pending_since=0))
+
+
+@migration
+def add_bookmark_stats_bucket_index(conn):
+    add_index(conn, BookmarkStat, 'ix_bookmark_stats_granularity_bucket')
+
+
+def current_version(conn):
+    # Returns None for an empty database
+    if not engine.dialect.has_table(conn, SchemaVersion.__tablename__):
+        # Databases created before migrations existed are at version 0
+        if engine.dialect.has_table(conn, Bookmark.__tablename__):
+            return 0
+        return None
+    return conn.execute(SchemaVersion.__table__.select()).scalar() or 0
+
+
+def set_version(conn, version):
+    table = SchemaVersion.__table__
+    conn.execute(table.delete())
+    conn.execute(table.insert().values(version=version))
+
+
+def migrate():
+    # Bring database schema up to date in a single transaction, and return
+    # the new version
+    with engine.begin() as conn:
+        version = current_version(conn)
+        # Empty database gets the current schema
+        if version is None:
+            Base.metadata.create_all(bind=conn)
+            set_version(conn, len(migrations))
+            return len(migrations)
+        SchemaVersion.__table__.create(conn, checkfirst=True)
+        for version, upgrade in enumerate(migrations[version:], version + 1):
+            upgrade(conn)
+            set_version(conn, version)
+        return len(migrations)
+
+
+if __name__ == '__main__':
+    print('Database schema is at version {}'.format(migrate()))
@@ -1,16 +1,36 @@
-from sqlalchemy import (Column, Integer, String, Text, ForeignKey)
+import time
+
+from sqlalchemy import (Column, BigInteger, Boolean, Integer, String, Text,
+                        ForeignKey, Index, select)
 from sqlalchemy.orm import relationship
 import bcrypt
 
 from bookmarks_service.database import Base
+from bookmarks_service.utils import url_hash
+
+
+class JSONMixin(object):
+    # Models give the columns their json needs in json_columns, and build it
+    # in row_json, which works on both model objects and plain rows. Listings
+    # can then select just those columns and skip building model objects.
+    @classmethod
+    def json_select(cls):
+        return select([cls.__table__.c[name] for name in cls.json_columns])
+
+    def json(self):
+        return self.row_json(self)
 
 
-class User(Base):
+class User(JSONMixin, Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     name = Column(String(120))
     email = Column(String(256), unique=True, nullable=False)
     password_hash = Column(String(60), nullable=False)
+    # Bumped on every change to the user's bookmarks, so ETags of bookmark
+    # responses can be checked without loading any bookmarks
+    bookmarks_version = Column(BigInteger, nullable=False, default=0,
+                               server_default='0')
 
     bookmarks = relationship("Bookmark", back_populates="user")
 
@@ -24,14 +44,25 @@ class User(Base):
     def __repr__(self):
         return '<User %r>' % (self.name)
 
-    def json(self):
+    json_columns = ('id', 'name', 'email')
+
+    @staticmethod
+    def row_json(row):
         return {
-            'id': self.id,
-            'name': self.name,
-            'email': self.email
+            'id': row.id,
+            'name': row.name,
+            'email': row.email
         }
 
 
+def bump_bookmarks_version(user_ids):
+    # Statement marking users' bookmarks as changed. user_ids can be a list
+    # or a select of user ids.
+    table = User.__table__
+    return table.update().where(table.c.id.in_(user_ids)).values(
+        bookmarks_version=table.c.bookmarks_version + 1)
+
+
 class SuperUser(Base):
     __tablename__ = 'superusers'
     id = Column(Integer, primary_key=True)
@@ -44,7 +75,7 @@ class SuperUser(Base):
         ).decode('utf-8')
 
 
-class API_Key(Base):
+class API_Key(JSONMixin, Base):
     __tablename__ = 'api_keys'
     id = Column(String(24), primary_key=True, unique=True, nullable=False)
     secret = Column(String(60), nullable=False)
@@ -52,6 +83,11 @@ class API_Key(Base):
     user_id = Column(Integer, ForeignKey('users.id'))
     user = relationship("User", back_populates="api_keys")
 
+    __table_args__ = (
+        # Listing a user's api keys, in id order
+        Index('ix_api_keys_user_id_id', 'user_id', 'id'),
+    )
+
     def __init__(self, id, secret, user_id):
         self.id = id
         self.secret = secret
@@ -60,33 +96,113 @@ class API_Key(Base):
     def __repr__(self):
         return '<API_Key %r>' % (self.id)
 
-    def json(self):
+    json_columns = ('id', 'secret', 'user_id')
+
+    @staticmethod
+    def row_json(row):
         return {
-            'id': self.id,
-            'secret': self.secret,
-            'user_id': self.user_id
+            'id': row.id,
+            'secret': row.secret,
+            'user_id': row.user_id
         }
 
 
-class Bookmark(Base):
+class Bookmark(JSONMixin, Base):
     __tablename__ = 'bookmarks'
     id = Column(String(6), primary_key=True, unique=True, nullable=False)
     url = Column(Text, nullable=False)
+    # One of 'pending', 'verified' or 'failed'. Bookmarks created in async
+    # mode are pending until their url has been verified in the background
+    status = Column(String(8), nullable=False, default='verified')
+    # Reason verification failed
+    error = Column(Text)
+    # Hash of normalized url, for finding duplicate bookmarks
+    url_hash = Column(String(64))
+    # Number of times short link has been followed. Clicks are written in
+    # batches, so this can lag behind by up to CLICK_FLUSH_SIZE clicks
+    hits = Column(BigInteger, nullable=False, default=0, server_default='0')
+    # Unix time a pending bookmark was queued for verification. Bookmarks
+    # pending for too long are queued again, in case the process verifying
+    # them died
+    pending_since = Column(BigInteger)
+    # Whether redirects are followed when verifying a pending bookmark, so a
+    # bookmark queued again is verified the same way
+    follow_redirects = Column(Boolean)
 
     user_id = Column(Integer, ForeignKey('users.id'))
     user = relationship("User", back_populates="bookmarks")
 
-    def __init__(self, id, url, user_id):
+    __table_args__ = (
+        # Listing a user's bookmarks, in id order
+        Index('ix_bookmarks_user_id_id', 'user_id', 'id'),
+        # Finding a user's bookmarks by url
+        Index('ix_bookmarks_user_id_url_hash', 'user_id', 'url_hash'),
+        # Finding bookmarks that have been pending for too long
+        Index('ix_bookmarks_pending_since', 'pending_since'),
+    )
+
+    def __init__(self, id, url, user_id, status='verified',
+                 follow_redirects=False):
         self.id = id
-        self.url = url
+        self.set_url(url)
         self.user_id = user_id
+        self.status = status
+        self.hits = 0
+        if status == 'pending':
+            self.pending_since = int(time.time())
+            self.follow_redirects = follow_redirects
+
+    def set_url(self, url):
+        # Keep url hash in step with url
+        self.url = url
+        self.url_hash = url_hash(url)
 
     def __repr__(self):
         return '<Bookmark %r>' % (self.id)
 
-    def json(self):
-        return {
-            'id': self.id,
-            'url': self.url,
-            'user_id': self.user_id
+    json_columns = ('id', 'url', 'user_id', 'status', 'error', 'hits')
+
+    @staticmethod
+    def row_json(row):
+        data = {
+            'id': row.id,
+            'url': row.url,
+            'user_id': row.user_id,
+            'status': row.status,
+            'hits': row.hits
         }
+        if row.error:
+            data['error'] = row.error
+        return data
+
+
+class BookmarkStat(Base):
+    # Number of clicks on a bookmark's short link in a time bucket. Bucket is
+    # the unix time the bucket starts at, and granularity is 'hour' or 'day'
+    __tablename__ = 'bookmark_stats'
+    bookmark_id = Column(String(6), ForeignKey('bookmarks.id'),
+                         primary_key=True)
+    granularity = Column(String(4), primary_key=True)
+    bucket = Column(BigInteger, primary_key=True, autoincrement=False)
+    hits = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        # Finding old hourly stats to compact
+        Index('ix_bookmark_stats_granularity_bucket', 'granularity',
+              'bucket'),
+    )
+
+    def __repr__(self):
+        return '<BookmarkStat %r %r %r>' % (
+            self.bookmark_id, self.granularity, self.bucket)
+
+
+class IdCounter(Base):
+    __tablename__ = 'id_counters'
+    name = Column(String(32), primary_key=True)
+    next_value = Column(BigInteger, nullable=False)
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
@@ -0,0 +1,58 @@
+import base64
+import binascii
+
+from flask import request, url_for
+
+from bookmarks_service import app
+from bookmarks_service.database import db_session
+
+
+def encode_cursor(key):
+    # Cursors are opaque to clients, but are just the encoded last key
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        return base64.b64decode(cursor + padding, altchars=b'-_',
+                                validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('Invalid after cursor')
+
+
+def page_args():
+    # Get limit and after arguments from request. Raises ValueError with a
+    # message for the client if either is invalid.
+    limit = request.args.get('limit', app.config['PAGE_SIZE'])
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError('Limit must be an integer')
+    if not 0 < limit <= app.config['MAX_PAGE_SIZE']:
+        raise ValueError('Limit must be between 1 and {}'.format(
+            app.config['MAX_PAGE_SIZE']))
+    after = request.args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after
+
+
+def paginate(statement, key, limit, after=None):
+    # Keyset pagination of a select statement. Rows are ordered by key and
+    # filtered to those after the cursor, so every page is an index range
+    # scan no matter how deep. Returns the page of rows and the url of the
+    # next page, if any.
+    if after is not None:
+        statement = statement.where(key > after)
+    rows = db_session.execute(
+        statement.order_by(key).limit(limit + 1)).fetchall()
+    next_url = None
+    # Fetched an extra row, so we know there is another page
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_url = url_for(
+            request.endpoint,
+            limit=limit,
+            after=encode_cursor(getattr(rows[-1], key.key)))
+    return rows, next_url
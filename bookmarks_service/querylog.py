@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from bookmarks_service import app
+from bookmarks_service.database import engine, replica_engine
+
+# Query logs currently recording, for each thread
+_local = threading.local()
+
+
+class QueryLog(object):
+    # Queries made while recording, with how long each took
+    def __init__(self):
+        self.queries = []
+
+    def __repr__(self):
+        return '<QueryLog %r>' % (self.count)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        return sum(elapsed for _, elapsed in self.queries)
+
+    def repeated(self):
+        # Statements made more than once, with how many times
+        counts = Counter(statement for statement, _ in self.queries)
+        return {statement: n for statement, n in counts.items() if n > 1}
+
+    def summary(self):
+        text = '{} queries in {:.1f} ms'.format(self.count, self.time * 1000)
+        repeated = self.repeated()
+        if repeated:
+            text += '. Repeated: ' + '; '.join(
+                '{} x{}'.format(' '.join(statement.split()), n)
+                for statement, n in sorted(repeated.items()))
+        return text
+
+
+def active_logs():
+    logs = getattr(_local, 'logs', None)
+    if logs is None:
+        logs = _local.logs = []
+    return logs
+
+
+def start():
+    # Start recording queries made by this thread
+    log = QueryLog()
+    active_logs().append(log)
+    return log
+
+
+def stop(log):
+    active_logs().remove(log)
+    return log
+
+
+@contextmanager
+def capture_queries():
+    # Record queries made by this thread in the with block
+    log = start()
+    try:
+        yield log
+    finally:
+        stop(log)
+
+
+def query_budget(count):
+    # Max number of queries a view should make, instead of QUERY_BUDGET.
+    # None means no budget, for views whose queries grow with their input.
+    # The budget is set on the function passed in, so put this directly
+    # under @app.route, where it gets the view that is registered.
+    def decorator(f):
+        f.query_budget = count
+        return f
+    return decorator
+
+
+def budget_for(view):
+    return getattr(view, 'query_budget', app.config['QUERY_BUDGET'])
+
+
+def instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        if active_logs():
+            conn.info.setdefault('query_log_start', []).append(
+                time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        logs = active_logs()
+        starts = conn.info.get('query_log_start')
+        if not logs or not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        for log in logs:
+            log.queries.append((statement, elapsed))
+
+
+instrument_engine(engine)
+if replica_engine is not None:
+    instrument_engine(replica_engine)
@@ -0,0 +1,165 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from bookmarks_service import app
+from bookmarks_service.cache import LRUCache
+
+# Outcome of taking a token. remaining is the whole tokens left, reset the
+# seconds until the bucket is full again, and retry_after the seconds until a
+# token is available, when none was.
+Limit = namedtuple('Limit', ['allowed', 'limit', 'remaining', 'reset',
+                             'retry_after'])
+
+
+def refill(tokens, updated, now, rate, burst):
+    # Tokens in a bucket that had tokens at updated
+    return min(burst, tokens + max(0, now - updated) * rate)
+
+
+def take_token(tokens, now, rate, burst, n=1):
+    # Take n tokens from a bucket holding tokens, or none when it holds
+    # fewer. Returns the tokens left and the Limit.
+    allowed = tokens >= n
+    if allowed:
+        tokens -= n
+    retry_after = 0 if allowed else math.ceil((n - tokens) / rate)
+    limit = Limit(allowed, burst, int(tokens),
+                  math.ceil((burst - tokens) / rate), retry_after)
+    return tokens, limit
+
+
+class MemoryBackend(object):
+    # Buckets held in this process only. Each worker process of a pre-fork
+    # server gets its own buckets, so use SQLiteBackend there.
+    def __init__(self, maxsize):
+        self._buckets = LRUCache('rate_limits', maxsize=maxsize, ttl=3600)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, n=1):
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens, limit = take_token(
+                refill(tokens, updated, now, rate, burst), now, rate, burst,
+                n)
+            # A bucket that has filled up again is the same as a new one
+            self._buckets.set(key, (tokens, now),
+                              ttl=(burst - tokens) / rate)
+        return limit
+
+    def prune(self, prefix, max_age):
+        # Buckets expire from the cache once full again
+        pass
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class SQLiteBackend(object):
+    # Buckets kept in a SQLite file, shared by every process on the host.
+    # Each take is a single write transaction, so processes never take the
+    # same token.
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS rate_limits ('
+            'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+            'updated REAL NOT NULL)')
+
+    def connection(self):
+        # One connection per thread, and a new one after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, rate, burst, n=1):
+        conn = self.connection()
+        now = time.time()
+        # Lock the database for writing before reading the bucket
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated FROM rate_limits WHERE key = ?',
+                (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens, limit = take_token(
+                refill(tokens, updated, now, rate, burst), now, rate, burst,
+                n)
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)',
+                (key, tokens, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return limit
+
+    def prune(self, prefix, max_age):
+        # Remove buckets starting with prefix that have not been used for
+        # max_age seconds, and so have filled up again
+        self.connection().execute(
+            "DELETE FROM rate_limits WHERE key LIKE ? || '%' AND updated < ?",
+            (prefix, time.time() - max_age))
+
+    def clear(self):
+        self.connection().execute('DELETE FROM rate_limits')
+
+
+class RateLimiter(object):
+    # Token bucket rate limits per api key, with a separate bucket for each
+    # kind of request. Rates and bursts are read from settings on each take.
+    # Every prune_every takes, buckets that have filled up are removed.
+    def __init__(self, backend, prune_every=1000):
+        self.backend = backend
+        self.prune_every = prune_every
+        self._takes = 0
+
+    def __repr__(self):
+        return '<RateLimiter %r>' % (type(self.backend).__name__)
+
+    def take(self, api_key_id, kind, n=1):
+        # kind is 'read' or 'create'. Requests that do the work of several
+        # take n tokens.
+        setting = 'RATE_LIMIT_{}_'.format(kind.upper())
+        rate = app.config[setting + 'RATE']
+        burst = app.config[setting + 'BURST']
+        self._takes += 1
+        if self._takes % self.prune_every == 0:
+            self.backend.prune(kind + ':', burst / rate)
+        return self.backend.take('{}:{}'.format(kind, api_key_id),
+                                 rate=rate, burst=burst, n=n)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_backend(config):
+    if config['RATE_LIMIT_FILE']:
+        return SQLiteBackend(config['RATE_LIMIT_FILE'])
+    return MemoryBackend(maxsize=config['RATE_LIMIT_MAX_KEYS'])
+
+
+rate_limiter = RateLimiter(create_backend(app.config))
+
+
+def limit_headers(limit):
+    # Standard rate limit headers for a Limit
+    headers = {
+        'RateLimit-Limit': str(limit.limit),
+        'RateLimit-Remaining': str(limit.remaining),
+        'RateLimit-Reset': str(limit.reset)
+    }
+    if not limit.allowed:
+        headers['Retry-After'] = str(limit.retry_after)
+    return headers
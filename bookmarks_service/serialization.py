@@ -0,0 +1,87 @@
+import json
+
+from bookmarks_service import app
+
+# orjson is much faster than the standard library encoder, so use it when it
+# is installed. See JSON_BACKEND in settings.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def stdlib_dumps(obj, pretty=False, sort_keys=False):
+    if pretty:
+        s = json.dumps(obj, indent=2, separators=(', ', ': '),
+                       sort_keys=sort_keys)
+    else:
+        s = json.dumps(obj, separators=(',', ':'), sort_keys=sort_keys)
+    return s.encode('utf-8')
+
+
+def orjson_dumps(obj, pretty=False, sort_keys=False):
+    option = 0
+    if pretty:
+        option |= orjson.OPT_INDENT_2
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    try:
+        return orjson.dumps(obj, option=option)
+    # orjson does not handle everything the standard library does, such as
+    # namedtuples, so fall back to it for those
+    except TypeError:
+        return stdlib_dumps(obj, pretty, sort_keys)
+
+
+def get_backend(name):
+    # Get dumps function for backend name ('auto', 'orjson' or 'stdlib')
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name == 'orjson':
+        if orjson is None:
+            raise RuntimeError('JSON_BACKEND is orjson, but it is not '
+                               'installed')
+        return orjson_dumps
+    if name == 'stdlib':
+        return stdlib_dumps
+    raise ValueError('Unknown JSON_BACKEND {!r}'.format(name))
+
+
+backend = get_backend(app.config['JSON_BACKEND'])
+
+
+def dumps(obj, pretty=False):
+    # Serialize obj to utf-8 encoded bytes
+    return backend(obj, pretty, app.config['JSON_SORT_KEYS'])
+
+
+def loads(data):
+    # Parse json from bytes or str. Raises ValueError when it is invalid.
+    if backend is orjson_dumps:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def response_body(data):
+    # Body of a json response, formatted like Flask's jsonify
+    return dumps(data, pretty=(app.config['JSONIFY_PRETTYPRINT_REGULAR'] or
+                               app.debug)) + b'\n'
+
+
+def jsonify(**data):
+    # Drop in replacement for Flask's jsonify, using the json backend
+    return app.response_class(response_body(data),
+                              mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
+class PrecomputedResponse(object):
+    # Json response that never changes, so its body is serialized just once.
+    # Calling it makes a new response, as after_request functions may change
+    # its headers.
+    def __init__(self, status, **data):
+        self.status = status
+        self.body = response_body(data)
+
+    def __call__(self):
+        return app.response_class(self.body, status=self.status,
+                                  mimetype=app.config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,69 @@
+from flask import Response, request, stream_with_context
+
+from bookmarks_service import app
+from bookmarks_service.database import db_session
+from bookmarks_service.serialization import dumps
+
+
+def stream_requested():
+    # Clients ask for a streamed response with stream=True
+    return request.args.get('stream') == 'True'
+
+
+def stream_rows(statement):
+    # Yield batches of rows from a server side cursor (stream_results)
+    result = db_session.execute(
+        statement.execution_options(stream_results=True))
+    while True:
+        rows = result.fetchmany(app.config['STREAM_BATCH_SIZE'])
+        if not rows:
+            break
+        yield rows
+
+
+def stream_json(name, statement, row_json):
+    # Stream results of a select statement as {name: [...]} without
+    # building the full list. Each batch of rows is written out before the
+    # next is fetched, so memory use stays flat no matter how many rows
+    # there are. row_json turns a row into its json.
+    def generate():
+        yield b'{' + dumps(name) + b': ['
+        first = True
+        for rows in stream_rows(statement):
+            chunk = b', '.join(dumps(row_json(row)) for row in rows)
+            yield chunk if first else b', ' + chunk
+            first = False
+        yield b']}\n'
+
+    # Keep request context (and database session) around while streaming
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def stream_ndjson(statement, row_json):
+    # Stream results of a select statement as newline delimited json, one
+    # row per line, in batches like stream_json
+    def generate():
+        for rows in stream_rows(statement):
+            yield b''.join(dumps(row_json(row)) + b'\n' for row in rows)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+def read_lines(stream, max_length):
+    # Read a request body a line at a time, so it is never all in memory.
+    # Yields the line number and line of every line that is not blank, with
+    # None for lines longer than max_length bytes, which are skipped.
+    number = 0
+    while True:
+        line = stream.readline(max_length + 1)
+        if not line:
+            return
+        number += 1
+        if len(line) > max_length and not line.endswith(b'\n'):
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_length + 1)
+            yield number, None
+        elif line.strip():
+            yield number, line
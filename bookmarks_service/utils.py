@@ -0,0 +1,45 @@
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+# Ports that are dropped from normalized urls
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    # Normalize url so equivalent urls compare equal. Lowercases scheme and
+    # host, drops default port, and uses / for an empty path. The fragment
+    # is kept, as it can point somewhere else on the page or hold a token.
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    # Leave urls we can not parse as they are
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ''
+    if ':' in netloc:
+        netloc = '[{}]'.format(netloc)
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, port)
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo = '{}:{}'.format(userinfo, parts.password)
+        netloc = '{}@{}'.format(userinfo, netloc)
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query,
+                       parts.fragment))
+
+
+def is_web_url(url):
+    # Whether url is an absolute http or https url with a host
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return False
+    return parts.scheme.lower() in DEFAULT_PORTS and bool(parts.hostname)
+
+
+def url_hash(url):
+    # Hash of normalized url, used to find a user's bookmarks by url
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
@@ -0,0 +1,279 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import and_, select
+
+from bookmarks_service import app
+from bookmarks_service.cache import LRUCache
+from bookmarks_service.database import db_session, engine
+from bookmarks_service.metrics import verification_seconds, verifications_total
+from bookmarks_service.models import Bookmark, bump_bookmarks_version
+from bookmarks_service.utils import normalize_url
+
+# Create user agent for requests
+USER_AGENT = '{}/{}'.format(
+    app.config['USER_AGENT_NAME'],
+    app.config['VERSION_NUMBER'])
+
+# Shared pool for verifying many urls at once. Bounds the number of
+# outbound requests in flight across all requests in this process.
+pool = ThreadPoolExecutor(max_workers=app.config['VERIFY_WORKERS'])
+# Pool for verifying bookmarks created in async mode, after the request that
+# created them has returned
+background_pool = ThreadPoolExecutor(
+    max_workers=app.config['VERIFY_BACKGROUND_WORKERS'])
+# Cache of verification results, by normalized url and follow_redirects.
+# Normalized urls keep their fragment, so one user's fragment is never
+# handed to another.
+# Failures are cached for VERIFY_NEGATIVE_CACHE_TTL seconds instead.
+verify_cache = LRUCache(
+    'verifications',
+    maxsize=app.config['VERIFY_CACHE_SIZE'],
+    ttl=app.config['VERIFY_CACHE_TTL'])
+# Verifications currently being made, so concurrent verifications of the
+# same url can wait on a single request
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+
+# Request errors, as classified by error_message. Verification outcomes are
+# counted by these classes.
+ERROR_CLASSES = (requests.exceptions.HTTPError, requests.exceptions.Timeout,
+                 requests.exceptions.ConnectionError,
+                 requests.exceptions.TooManyRedirects)
+
+
+def error_class(e):
+    # Name of the class error e is classified as
+    for cls in ERROR_CLASSES:
+        if isinstance(e, cls):
+            return cls.__name__
+    return type(e).__name__
+
+
+def error_message(e):
+    # Customize error message to request exception
+    if isinstance(e, requests.exceptions.HTTPError):
+        msg = str(e)
+    elif isinstance(e, requests.exceptions.Timeout):
+        msg = ('Timeout error. Please try again. If error continues, '
+               'please check that submitted url is correct.')
+    elif isinstance(e, requests.exceptions.ConnectionError):
+        msg = ('Could not connect to your url. '
+               'Please check that url is correct. ' + str(e))
+    elif isinstance(e, requests.exceptions.TooManyRedirects):
+        msg = ('Exceeded max number of redirects when connecting to '
+               'url. Please check URL.')
+    else:
+        msg = str(e)
+    return 'Error when connecting to submitted url: ' + msg
+
+
+class URLVerifier(object):
+    # Verifies urls over a shared session, so connections to the same host
+    # are kept alive and reused. Only the status and final url are needed,
+    # so response bodies are never downloaded.
+    def __init__(self, user_agent, timeout, max_hosts, max_per_host,
+                 max_bytes):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        self.session.headers['user-agent'] = user_agent
+        # Session is shared by all users, so never keep cookies
+        self.session.cookies.set_policy(
+            DefaultCookiePolicy(allowed_domains=[]))
+        # Keep a connection pool for up to max_hosts hosts, each keeping at
+        # most max_per_host connections open. When all of a host's
+        # connections are busy, another is opened and closed after use, as
+        # waiting for a free one would not count towards timeout. The
+        # verification pools bound how many are made at once.
+        adapter = HTTPAdapter(pool_connections=max_hosts,
+                              pool_maxsize=max_per_host,
+                              pool_block=False)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, url, follow_redirects=False):
+        # Try HEAD first, as it has no body
+        r = self.session.head(url, allow_redirects=follow_redirects,
+                              timeout=self.timeout)
+        r.close()
+        # Some servers do not support HEAD, so fall back to a streamed GET
+        if r.status_code >= 400:
+            r = self.session.get(url, allow_redirects=follow_redirects,
+                                 timeout=self.timeout, stream=True)
+            self.release(r)
+        return r
+
+    def release(self, r):
+        # Read at most max_bytes of the body. A body that fits is drained, so
+        # the connection goes back to the pool. Anything bigger is never
+        # downloaded, and the connection is closed instead.
+        try:
+            r.raw.read(self.max_bytes + 1, decode_content=False)
+        except Exception:
+            pass
+        r.close()
+
+    def verify(self, url, follow_redirects=False):
+        # Verify url by making request to it. Returns the final url
+        # (important for redirects) and None, or None and an error message.
+        start = time.perf_counter()
+        outcome = 'ok'
+        try:
+            r = self.request(url, follow_redirects)
+            r.raise_for_status()
+        # Catch request exceptions
+        except requests.exceptions.RequestException as e:
+            outcome = error_class(e)
+            return None, error_message(e)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            verification_seconds.observe(time.perf_counter() - start,
+                                         outcome=outcome)
+            verifications_total.inc(outcome=outcome)
+        return r.url, None
+
+
+verifier = URLVerifier(
+    user_agent=USER_AGENT,
+    timeout=app.config['TIMEOUT'],
+    max_hosts=app.config['VERIFY_POOL_HOSTS'],
+    max_per_host=app.config['VERIFY_POOL_PER_HOST'],
+    max_bytes=app.config['VERIFY_MAX_BYTES'])
+
+
+def verify_url(url, follow_redirects=False):
+    # Verify url, using a cached result when there is one
+    key = (normalize_url(url), follow_redirects)
+    result = verify_cache.get(key)
+    if result is not None:
+        return result
+    with in_flight_lock:
+        future = in_flight.get(key)
+        leader = future is None
+        if leader:
+            future = in_flight[key] = Future()
+    # Another thread is verifying this url, so wait for its result
+    if not leader:
+        return future.result()
+    try:
+        result = verifier.verify(url, follow_redirects)
+        ttl = None if result[1] is None else \
+            app.config['VERIFY_NEGATIVE_CACHE_TTL']
+        verify_cache.set(key, result, ttl=ttl)
+        future.set_result(result)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with in_flight_lock:
+            del in_flight[key]
+    return result
+
+
+def verify_urls(urls, follow_redirects=False):
+    # Verify urls concurrently. Results are in the same order as urls.
+    return list(pool.map(
+        lambda url: verify_url(url, follow_redirects), urls))
+
+
+def verify_pending_bookmark(bookmark_id, url, follow_redirects=False):
+    # Verify a pending bookmark and mark it as verified or failed
+    url, error = verify_url(url, follow_redirects)
+    try:
+        bookmark = Bookmark.query.get(bookmark_id)
+        # Bookmark was queued again, and already verified by the other try
+        if bookmark is None or bookmark.status != 'pending':
+            return
+        bookmark.pending_since = None
+        if error:
+            bookmark.status = 'failed'
+            bookmark.error = error
+        else:
+            bookmark.status = 'verified'
+            bookmark.set_url(url)
+        db_session.execute(bump_bookmarks_version([bookmark.user_id]))
+        db_session.commit()
+    except Exception:
+        app.logger.exception('Could not save verification of bookmark %s',
+                             bookmark_id)
+        db_session.rollback()
+    finally:
+        # Worker threads have their own session, which must be cleaned up
+        db_session.remove()
+
+
+def verify_in_background(bookmark_id, url, follow_redirects=False):
+    # Bookmark must already be committed as pending
+    return background_pool.submit(
+        verify_pending_bookmark, bookmark_id, url, follow_redirects)
+
+
+def requeue_pending(now=None, limit=1000):
+    # Queue bookmarks pending for over VERIFY_PENDING_TIMEOUT seconds for
+    # verification again, as the process verifying them may have died.
+    # Each one is claimed by moving its pending_since on, so only one process
+    # queues it. Returns futures of the verifications queued.
+    if now is None:
+        now = time.time()
+    table = Bookmark.__table__
+    cutoff = now - app.config['VERIFY_PENDING_TIMEOUT']
+    with engine.begin() as conn:
+        rows = conn.execute(
+            select([table.c.id, table.c.url, table.c.follow_redirects,
+                    table.c.pending_since]).where(
+                and_(table.c.status == 'pending',
+                     table.c.pending_since < cutoff)).limit(limit)).fetchall()
+    futures = []
+    for b_id, url, follow_redirects, pending_since in rows:
+        with engine.begin() as conn:
+            claimed = conn.execute(table.update().where(and_(
+                table.c.id == b_id,
+                table.c.pending_since == pending_since)).values(
+                    pending_since=int(now))).rowcount
+        if claimed:
+            futures.append(verify_in_background(
+                b_id, url, bool(follow_redirects)))
+    if futures:
+        app.logger.warning('Queued %s stale pending bookmarks again',
+                           len(futures))
+    return futures
+
+
+class PendingRecovery(object):
+    # Calls requeue_pending every interval seconds, starting with this
+    # process's first request. Runs on the background pool, so requests never
+    # wait on it.
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<PendingRecovery %r>' % (self.interval)
+
+    def maybe_run(self):
+        now = time.monotonic()
+        if now < self._next:
+            return
+        with self._lock:
+            if now < self._next:
+                return
+            self._next = now + self.interval
+        background_pool.submit(self.run)
+
+    def run(self):
+        try:
+            requeue_pending()
+        except Exception:
+            app.logger.exception('Could not queue pending bookmarks again')
+
+
+pending_recovery = PendingRecovery(app.config['VERIFY_PENDING_TIMEOUT'])
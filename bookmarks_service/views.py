@@ -1,22 +1,163 @@
 import random
 import re
 import string
+import time
 from functools import wraps
 
-from flask import g, abort, jsonify, make_response, render_template, request
-import requests
+from flask import (g, abort, make_response, redirect, render_template,
+                   request, Response)
 import bcrypt
 
-from bookmarks_service import app
-from bookmarks_service.database import db_session
-from bookmarks_service.models import User, SuperUser, Bookmark, API_Key
+from bookmarks_service import app, querylog
+from bookmarks_service.analytics import GRANULARITIES, click_counter, get_stats
+from bookmarks_service.auth import (authenticate_api_key, check_password,
+                                    keyed_digest)
+from bookmarks_service.cache import LRUCache, caches
+from bookmarks_service.compression import compress_response, etag_variants
+from bookmarks_service.database import (db_session, engine, pool_stats,
+                                        read_only, reading_replica,
+                                        replica_pool_stats)
+from bookmarks_service.ids import new_bookmark_ids
+from bookmarks_service.metrics import (export, requests_total,
+                                       request_seconds, start_snapshots)
+from bookmarks_service.models import (User, SuperUser, Bookmark, API_Key,
+                                      bump_bookmarks_version)
+from bookmarks_service.pagination import page_args, paginate
+from bookmarks_service.querylog import query_budget
+from bookmarks_service.ratelimit import limit_headers, rate_limiter
+from bookmarks_service.serialization import (PrecomputedResponse, jsonify,
+                                             loads)
+from bookmarks_service.streaming import (read_lines, stream_json,
+                                         stream_ndjson, stream_requested)
+from bookmarks_service.utils import is_web_url, normalize_url, url_hash
+from bookmarks_service.verification import (pending_recovery, verify_url,
+                                            verify_urls, verify_in_background)
 
-# Create user agent for requests
-USER_AGENT = '{}/{}'.format(
-    app.config['USER_AGENT_NAME'],
-    app.config['VERSION_NUMBER'])
-# Timeout for requests library
-TIMEOUT = app.config['TIMEOUT']
+# Cache of bookmark id to url, used by short link redirects
+redirect_cache = LRUCache(
+    'redirects',
+    maxsize=app.config['REDIRECT_CACHE_SIZE'],
+    ttl=app.config['REDIRECT_CACHE_TTL'])
+# Clients that recently wrote, whose reads go to the primary database
+recent_writers = LRUCache(
+    'recent_writers',
+    maxsize=10000,
+    ttl=app.config['REPLICA_STICKY_SECONDS'])
+
+# Error responses that never change, serialized once at startup
+NO_AUTH_HEADER = PrecomputedResponse(
+    401, error='Unauthorized', code='401',
+    message='You must include a proper authorization header')
+NO_CREDENTIALS = PrecomputedResponse(
+    401, error='Unauthorized', code='401',
+    message='You must include a username and password')
+NO_SUPER_CREDENTIALS = PrecomputedResponse(
+    401, error='Unauthorized', code='401',
+    message='You must include a valid username and password')
+NOT_AUTHENTICATED = PrecomputedResponse(
+    401, error='Unauthorized', code='401',
+    message='You must be authenticated to access')
+NOT_AUTHORIZED = PrecomputedResponse(
+    401, error='Unauthorized', code='401',
+    message='You are not authorized to access this route')
+BAD_BOOKMARK_ID = PrecomputedResponse(
+    400, error='Bad Request', code='400',
+    message='Bookmark id must be 6 alphanumeric characters')
+URL_REQUIRED = PrecomputedResponse(
+    400, error='Bad Request', code='400',
+    message='URL is required')
+URLS_REQUIRED = PrecomputedResponse(
+    400, error='Bad Request', code='400',
+    message='A list of URLs is required')
+BAD_USER_DATA = PrecomputedResponse(
+    400, error='Bad Request', code='400',
+    message='Please check request data')
+USER_EXISTS = PrecomputedResponse(
+    409, error='Conflict', code='409',
+    message='A user with this email already exists')
+RATE_LIMITED = PrecomputedResponse(
+    429, error='Too Many Requests', code='429',
+    message='Rate limit exceeded. See the Retry-After header')
+
+
+def client_id():
+    auth = request.authorization
+    return auth and auth.get('username')
+
+
+@app.before_request
+def start_timer():
+    start_snapshots()
+    pending_recovery.maybe_run()
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    # Requests that match no route are counted together
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    start = g.get('request_start')
+    if start is not None:
+        request_seconds.observe(time.perf_counter() - start, route=route,
+                                method=request.method)
+    requests_total.inc(route=route, method=request.method,
+                       status=response.status_code)
+    return response
+
+
+@app.before_request
+def route_reads():
+    # Read only requests read from the replica, unless client recently wrote
+    db_session().info['read_only'] = (
+        request.method in ('GET', 'HEAD') and
+        recent_writers.get(client_id()) is None)
+
+
+@app.after_request
+def remember_writes(response):
+    if (request.method not in ('GET', 'HEAD') and client_id() and
+            response.status_code < 400):
+        recent_writers.set(client_id(), True)
+    return response
+
+
+@app.after_request
+def add_rate_limit_headers(response):
+    limit = g.get('rate_limit')
+    if limit is not None:
+        response.headers.extend(limit_headers(limit))
+    return response
+
+
+@app.after_request
+def compress(response):
+    return compress_response(response)
+
+
+@app.before_request
+def start_query_log():
+    g.query_log = querylog.start()
+
+
+@app.teardown_request
+def check_query_budget(exception=None):
+    log = g.get('query_log')
+    if log is None:
+        return
+    querylog.stop(log)
+    # Only checked in debug mode, so tests and development catch extra
+    # queries
+    if not app.debug:
+        return
+    view = app.view_functions.get(request.endpoint)
+    budget = querylog.budget_for(view)
+    if budget is not None and log.count > budget:
+        app.logger.warning('%s %s is over its budget of %s queries: %s',
+                           request.method, request.path, budget,
+                           log.summary())
+    else:
+        app.logger.debug('%s %s: %s', request.method, request.path,
+                         log.summary())
 
 
 @app.teardown_appcontext
@@ -24,6 +165,15 @@ def shutdown_session(exception=None):
     db_session.remove()
 
 
+def get_fresh(model, id):
+    # Get row by id, checking the primary if it is not on the replica yet
+    row = model.query.get(id)
+    if row is None and reading_replica():
+        with read_only(False):
+            row = model.query.get(id)
+    return row
+
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -34,26 +184,17 @@ def login_required(f):
         # Catches exception if there is no authorization header or not
         # formatted as basic authorization
         except TypeError as e:
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must include a proper authorization header'
-            ), 401
+            return NO_AUTH_HEADER()
         # Catches exception if authorization header does not include username
         # and password
         except KeyError as e:
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must include a username and password'
-            ), 401
-        user = User.query.get(user_id)
+            return NO_CREDENTIALS()
+        with read_only():
+            user = get_fresh(User, user_id)
         # Check that user exists and secret matches api_key secret
-        if not (user and bcrypt.checkpw(password.encode('utf-8'),
-                                        user.password_hash.encode('utf-8'))
-                ):
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must be authenticated to access'
-            ), 401
+        if not (user and check_password('user', user.id, password,
+                                        user.password_hash)):
+            return NOT_AUTHENTICATED()
         # Store user
         g.user = user
         # Continue with function
@@ -74,10 +215,7 @@ def is_authorized(f):
             user_id = g.bookmark.user_id
         # Check if there is an authenticated user and they are authorized
         if not g.user or g.user.id != user_id:
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You are not authorized to access this route'
-            ), 401
+            return NOT_AUTHORIZED()
         return f(*args, **kwargs)
     return decorated_function
 
@@ -92,28 +230,20 @@ def super_auth_required(f):
         # Catches exception if there is no authorization header or not
         # formatted as basic authorization
         except TypeError as e:
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must include a proper authorization header'
-            ), 401
+            return NO_AUTH_HEADER()
         # Catches exception if authorization header does not include username
         # and password
         except KeyError as e:
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must include a valid username and password'
-            ), 401
-        super_user = SuperUser.query.get(super_user_id)
+            return NO_SUPER_CREDENTIALS()
+        with read_only():
+            super_user = get_fresh(SuperUser, super_user_id)
         # Check that user exists and secret matches api_key secret
         if not (
-            super_user and bcrypt.checkpw(
-                password.encode('utf-8'),
-                super_user.password_hash.encode('utf-8')
+            super_user and check_password(
+                'super_user', super_user.id, password,
+                super_user.password_hash
                 )):
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must be authenticated to access'
-            ), 401
+            return NOT_AUTHENTICATED()
         # Store user
         g.super_user = super_user
         # Continue with function
@@ -131,33 +261,43 @@ def auth_required(f):
         # Catches exception if there is no authorization header or not
         # formatted as basic authorization
         except TypeError as e:
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must include a proper authorization header'
-            ), 401
+            return NO_AUTH_HEADER()
         # Catches exception if authorization header does not include username
         # and password
         except KeyError as e:
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must include a username and password'
-            ), 401
-        # Get api key
-        api_key = API_Key.query.get(api_key_id)
-        # Check that api_key exists and secret matches api_key secret
-        if not api_key or api_key.secret != secret:
-            return jsonify(
-                error='Unauthorized', code='401',
-                message='You must be authenticated to access'
-            ), 401
+            return NO_CREDENTIALS()
+        # Get api key and check that secret matches api_key secret
+        with read_only():
+            authenticated = authenticate_api_key(api_key_id, secret)
+            # A new api key may not be on the replica yet. Keys found there
+            # are cached, so only unknown keys are looked up again.
+            if not authenticated and reading_replica():
+                with read_only(False):
+                    authenticated = authenticate_api_key(api_key_id, secret)
+        if not authenticated:
+            return NOT_AUTHENTICATED()
         # Store user and api key
-        g.api_key = api_key
-        g.user = api_key.user
+        g.api_key, g.user = authenticated
+        # Rate limit api key, with a separate budget for creating bookmarks
+        kind = 'create' if request.method == 'POST' else 'read'
+        g.rate_limit = rate_limiter.take(g.api_key.id, kind)
+        if not g.rate_limit.allowed:
+            return RATE_LIMITED()
         # Continue with function
         return f(*args, **kwargs)
     return decorated_function
 
 
+def take_create_tokens(n):
+    # Take n more create tokens, for requests that create many bookmarks.
+    # auth_required already took one for the request. Returns whether the
+    # api key's rate limit allowed it.
+    if n < 1:
+        return True
+    g.rate_limit = rate_limiter.take(g.api_key.id, 'create', n)
+    return g.rate_limit.allowed
+
+
 def verify_bookmark(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -165,13 +305,9 @@ def verify_bookmark(f):
         bookmark_id = kwargs['bookmark_id']
         # Verify bookmark id
         if not re.fullmatch('^[0-9a-z]{6}$', bookmark_id):
-            return (jsonify(
-                error='Bad Request',
-                code='400',
-                message='Bookmark id must be 6 alphanumeric characters'
-            ), 400)
+            return BAD_BOOKMARK_ID()
         # Query bookmark
-        bookmark = Bookmark.query.get(bookmark_id)
+        bookmark = get_fresh(Bookmark, bookmark_id)
         if not bookmark:
             return (jsonify(
                 error='Not Found',
@@ -185,90 +321,422 @@ def verify_bookmark(f):
     return decorated_function
 
 
+def conditional(f):
+    # Give GET responses a strong ETag, and answer with 304 when the client
+    # already has it. ETags come from the user's bookmarks version, so this
+    # costs a single lookup by primary key, and no bookmarks are loaded.
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method != 'GET':
+            return f(*args, **kwargs)
+        # Version is read before the response is built, so a write in
+        # between can only make the ETag older than the response, never
+        # newer
+        version = db_session.query(User.bookmarks_version).filter(
+            User.id == g.user.id).scalar()
+        # Keyed, so ETags can not be made up for other users' bookmarks
+        etag = keyed_digest('{}:{}:{}'.format(
+            g.user.id, version, request.full_path)).hex()[:32]
+        # Client may hold the ETag of a compressed response
+        matched = [variant for variant in etag_variants(etag)
+                   if request.if_none_match.contains_weak(variant)]
+        if matched:
+            response = Response(status=304)
+            response.set_etag(matched[0])
+            return response
+        response = make_response(f(*args, **kwargs))
+        # Errors, such as a bad bookmark id, get no ETag
+        if response.status_code == 200:
+            response.set_etag(etag)
+        return response
+    return decorated_function
+
+
 @app.route('/', methods=['GET'])
 def front_page():
     return render_template('front_page.html')
 
 
+def existing_bookmarks(urls):
+    # Find user's existing bookmarks for urls, by url hash
+    hashes = {url_hash(url) for url in urls}
+    if not hashes:
+        return {}
+    bookmarks = Bookmark.query.filter(
+        Bookmark.user_id == g.user.id,
+        Bookmark.url_hash.in_(list(hashes)),
+        Bookmark.status != 'failed')
+    return {b.url_hash: b for b in bookmarks}
+
+
+def existing_response(bookmark):
+    # Respond with a bookmark that already exists
+    response = make_response(
+        jsonify(
+            bookmark=bookmark.json()
+        )
+    )
+    response.headers['Location'] = '/bookmarks/{}'.format(bookmark.id)
+    return response, 200
+
+
+def page_response(name, model, statement, key):
+    # Respond with a single page of results of a select statement, stored
+    # under name. Rows are turned into json by model, without building
+    # model objects.
+    try:
+        limit, after = page_args()
+    except ValueError as e:
+        return (jsonify(
+            error='Bad Request',
+            code='400',
+            message=str(e)
+        ), 400)
+    rows, next_url = paginate(statement, key, limit, after)
+    data = {name: [model.row_json(row) for row in rows]}
+    # Only include link to next page when there is one
+    if next_url:
+        data['next'] = next_url
+    response = make_response(jsonify(**data))
+    if next_url:
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
+
+
+@app.route('/<bookmark_id>', methods=['GET'])
+@query_budget(1)
+def redirect_bookmark(bookmark_id):
+    # Anything that is not a bookmark id is simply not found
+    if not re.fullmatch('^[0-9a-z]{6}$', bookmark_id):
+        abort(404)
+    # Check cache before querying database
+    url = redirect_cache.get(bookmark_id)
+    if url is None:
+        bookmark = get_fresh(Bookmark, bookmark_id)
+        # Only verified bookmarks can be followed
+        if not bookmark or bookmark.status != 'verified':
+            return (jsonify(
+                error='Not Found',
+                code='404',
+                message=('There is no bookmark with the id={}'
+                         .format(bookmark_id))
+            ), 404)
+        url = bookmark.url
+        redirect_cache.set(bookmark_id, url)
+    click_counter.record(bookmark_id)
+    return redirect(url, code=app.config['REDIRECT_CODE'])
+
+
+@app.route('/stats', methods=['GET'])
+@query_budget(1)
+@super_auth_required
+def stats():
+    return jsonify(stats={
+        'caches': {name: c.stats() for name, c in caches.items()},
+        'clicks': click_counter.stats(),
+        'pool': pool_stats(engine),
+        'replica_pool': replica_pool_stats()
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+@query_budget(1)
+@super_auth_required
+def metrics():
+    return Response(export(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/bookmarks', methods=['GET', 'POST'])
+@query_budget(6)
 @auth_required
+@conditional
 def bookmarks():
     if request.method == 'POST':
         # Get data
         url = request.form.get('url')
         follow_redirects = request.form.get('follow_redirects') == 'True'
+        verify_async = request.form.get('async') == 'True'
         # Verify required data sent
         if not (url):
-            return (jsonify(
-                error='Bad Request',
-                code='400',
-                message='URL is required'
-            ), 400)
-        # Verify submitted URL by making request to that URL
-        try:
-            user_agent = '{}/{}'.format(
-                app.config['USER_AGENT_NAME'],
-                app.config['VERSION_NUMBER']
-            )
-            r = requests.get(
-                url,
-                headers={'user-agent': user_agent},
-                allow_redirects=follow_redirects,
-                timeout=app.config['TIMEOUT']
+            return URL_REQUIRED()
+        dedup = app.config['DEDUPLICATE_BOOKMARKS']
+        # Return existing bookmark for url, without verifying it again
+        if dedup:
+            existing = existing_bookmarks([url]).get(url_hash(url))
+            if existing:
+                return existing_response(existing)
+        # In async mode, save bookmark as pending and verify it later
+        if verify_async:
+            b = Bookmark(id=new_bookmark_ids(1)[0], url=url,
+                         user_id=g.user.id, status='pending',
+                         follow_redirects=follow_redirects)
+            db_session.add(b)
+            # Build json before commit expires the bookmark, which would
+            # take another query to reload
+            b_json = b.json()
+            db_session.execute(bump_bookmarks_version([g.user.id]))
+            db_session.commit()
+            verify_in_background(b_json['id'], url, follow_redirects)
+            response = make_response(
+                jsonify(
+                    bookmark=b_json
+                )
             )
-            r.raise_for_status()
-        # Catch request exceptions
-        except requests.exceptions.RequestException as e:
-            # Customize error message to request exception
-            if isinstance(e, requests.exceptions.HTTPError):
-                msg = str(e)
-            elif isinstance(e, requests.exceptions.Timeout):
-                msg = ('Timeout error. Please try again. If error continues, '
-                       'please check that submitted url is correct.')
-            elif isinstance(e, requests.exceptions.ConnectionError):
-                msg = ('Could not connect to your url. '
-                       'Please check that url is correct. ' + str(e))
-            elif isinstance(e, requests.exceptions.TooManyRedirects):
-                msg = ('Exceeded max number of redirects when connecting to '
-                       'url. Please check URL.')
-            else:
-                msg = str(e)
+            # Provide location to check on bookmark status
+            response.headers['Location'] = '/bookmarks/{}'.format(
+                b_json['id'])
+            return response, 202
+        # Verify submitted URL by making request to that URL
+        submitted = url
+        url, error = verify_url(url, follow_redirects)
+        if error:
             return (jsonify(
                 error='Bad Request',
                 code='400',
-                message='Error when connecting to submitted url: ' + msg
+                message=error
             ), 400)
-        else:
-            # If url success, get final url (important for redirects)
-            url = r.url
+        # Url may have redirected to one that is already bookmarked
+        if dedup and url_hash(url) != url_hash(submitted):
+            existing = existing_bookmarks([url]).get(url_hash(url))
+            if existing:
+                return existing_response(existing)
         # Successfully verified, time to create bookmark.
-        # Generate random 6 character alphanumeric id
-        while True:
-            b_id = ''.join(random.choice(
-                string.ascii_lowercase + string.digits) for _ in range(6))
-            # Check that id does not exist
-            if Bookmark.query.get(b_id) is None:
-                break
+        # Allocate unique 6 character alphanumeric id
+        b_id = new_bookmark_ids(1)[0]
         # Create bookmark in database
         b = Bookmark(id=b_id, url=url, user_id=g.user.id)
         db_session.add(b)
+        b_json = b.json()
+        db_session.execute(bump_bookmarks_version([g.user.id]))
         db_session.commit()
         # Craft response
         response = make_response(
             jsonify(
-                bookmark=b.json()
+                bookmark=b_json
             )
         )
         # Provide location of user resource
-        response.headers['Location'] = '/bookmarks/{}'.format(b.id)
+        response.headers['Location'] = '/bookmarks/{}'.format(b_id)
         return response, 201
-    # Get all bookmarks
-    bookmarks = Bookmark.query.filter_by(user_id=g.user.id).all()
-    return jsonify(bookmarks=[b.json() for b in bookmarks])
+    bookmarks = Bookmark.json_select().where(Bookmark.user_id == g.user.id)
+    # Stream all bookmarks
+    if stream_requested():
+        return stream_json('bookmarks', bookmarks.order_by(Bookmark.id),
+                           Bookmark.row_json)
+    # Get a page of bookmarks
+    return page_response('bookmarks', Bookmark, bookmarks, Bookmark.id)
+
+
+@app.route('/bookmarks/batch', methods=['POST'])
+@query_budget(6)
+@auth_required
+def batch_bookmarks():
+    # Get data, either as json or as repeated url form fields
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            data = {}
+        urls = data.get('urls')
+        follow_redirects = data.get('follow_redirects') in (True, 'True')
+    else:
+        urls = request.form.getlist('url')
+        follow_redirects = request.form.get('follow_redirects') == 'True'
+    # Verify required data sent
+    if not (urls and isinstance(urls, list) and
+            all(isinstance(url, str) for url in urls)):
+        return URLS_REQUIRED()
+    # Each url takes a create token, so batches bigger than the burst could
+    # never be allowed
+    max_urls = min(app.config['BATCH_MAX_URLS'],
+                   app.config['RATE_LIMIT_CREATE_BURST'])
+    if len(urls) > max_urls:
+        return (jsonify(
+            error='Bad Request',
+            code='400',
+            message='At most {} URLs can be created at once'.format(
+                max_urls)
+        ), 400)
+    # Every url is verified, so each takes a create token. The request
+    # itself paid for one.
+    if not take_create_tokens(len(urls) - 1):
+        return RATE_LIMITED()
+    # Find urls that are already bookmarked, which need no verifying
+    dedup = app.config['DEDUPLICATE_BOOKMARKS']
+    existing = existing_bookmarks(urls) if dedup else {}
+    # Verify all other urls concurrently
+    to_verify = [url for url in urls if url_hash(url) not in existing]
+    verified = dict(zip(to_verify, verify_urls(to_verify, follow_redirects)))
+    # Final urls may have redirected to ones that are already bookmarked
+    if dedup:
+        existing.update(existing_bookmarks(
+            url for url, error in verified.values() if not error))
+    ids = iter(new_bookmark_ids(
+        sum(1 for url in to_verify if not verified[url][1])))
+    results = []
+    created = []
+    for submitted in urls:
+        bookmark = existing.get(url_hash(submitted))
+        if not bookmark:
+            url, error = verified[submitted]
+            if error:
+                results.append({
+                    'url': submitted,
+                    'error': {
+                        'error': 'Bad Request',
+                        'code': '400',
+                        'message': error
+                    }
+                })
+                continue
+            bookmark = existing.get(url_hash(url))
+        if not bookmark:
+            bookmark = Bookmark(id=next(ids), url=url, user_id=g.user.id)
+            created.append(bookmark)
+            # Later duplicates in this batch get the same bookmark
+            if dedup:
+                existing[url_hash(submitted)] = bookmark
+                existing[bookmark.url_hash] = bookmark
+        results.append({'url': submitted, 'bookmark': bookmark.json()})
+    # Create all bookmarks in database with a single bulk insert
+    if created:
+        db_session.bulk_save_objects(created)
+        db_session.execute(bump_bookmarks_version([g.user.id]))
+        db_session.commit()
+    return jsonify(results=results)
+
+
+@app.route('/bookmarks/export', methods=['GET'])
+@query_budget(2)
+@auth_required
+def export_bookmarks():
+    # Stream all of user's bookmarks as newline delimited json, which can be
+    # imported again with /bookmarks/import
+    bookmarks = Bookmark.json_select().where(
+        Bookmark.user_id == g.user.id).order_by(Bookmark.id)
+    response = stream_ndjson(bookmarks, Bookmark.row_json)
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=bookmarks.ndjson')
+    return response
+
+
+def import_batch(batch, trust_urls, follow_redirects):
+    # Create bookmarks for a batch of (line number, url) with a single bulk
+    # insert, and commit them. Returns the number created, the number that
+    # were already bookmarked, and (line number, url, error) for each url
+    # that failed verification.
+    # Trusted urls are not requested, but must still be web urls, as short
+    # links redirect to them. They are saved normalized, as verified urls are.
+    if trust_urls:
+        verified = [(normalize_url(url), None) if is_web_url(url) else
+                    (None, 'URL must start with http:// or https:// and '
+                     'have a host')
+                    for _, url in batch]
+    else:
+        verified = verify_urls([url for _, url in batch], follow_redirects)
+    errors = [(line, submitted, error)
+              for (line, submitted), (_, error) in zip(batch, verified)
+              if error]
+    urls = [url for url, error in verified if not error]
+    # Skip urls already bookmarked, including earlier in the import
+    dedup = app.config['DEDUPLICATE_BOOKMARKS']
+    seen = set(existing_bookmarks(urls)) if dedup else set()
+    rows = []
+    for url in urls:
+        hashed = url_hash(url)
+        if hashed in seen:
+            continue
+        if dedup:
+            seen.add(hashed)
+        rows.append({'url': url, 'url_hash': hashed, 'user_id': g.user.id,
+                     'status': 'verified', 'hits': 0})
+    for row, b_id in zip(rows, new_bookmark_ids(len(rows))):
+        row['id'] = b_id
+    if rows:
+        db_session.execute(Bookmark.__table__.insert(), rows)
+        db_session.execute(bump_bookmarks_version([g.user.id]))
+        db_session.commit()
+    return len(rows), len(urls) - len(rows), errors
+
+
+@app.route('/bookmarks/import', methods=['POST'])
+@query_budget(None)
+@auth_required
+def import_bookmarks():
+    # Create bookmarks from a newline delimited json upload, with a
+    # {"url": ...} object on each line. The upload is read and imported
+    # IMPORT_BATCH_SIZE lines at a time, so memory use stays flat no matter
+    # its size. Each batch is committed on its own.
+    # Urls to verify take a create token each, and trusted urls a token per
+    # batch. When the rate limit is reached, the lines read so far are
+    # imported and the rest are left for the client to send again later.
+    trust_urls = request.args.get('trust_urls') == 'True'
+    follow_redirects = request.args.get('follow_redirects') == 'True'
+    batch_size = app.config['IMPORT_BATCH_SIZE']
+    summary = {'created': 0, 'existing': 0, 'failed': 0, 'errors': []}
+
+    def fail(line, message, url=None):
+        summary['failed'] += 1
+        if len(summary['errors']) < app.config['IMPORT_MAX_ERRORS']:
+            error = {'line': line, 'message': message}
+            if url is not None:
+                error['url'] = url
+            summary['errors'].append(error)
+
+    def flush(batch):
+        created, existing, errors = import_batch(
+            batch, trust_urls, follow_redirects)
+        summary['created'] += created
+        summary['existing'] += existing
+        for line, url, error in errors:
+            fail(line, error, url)
+
+    batch = []
+    # Token taken for the request by auth_required
+    credit = 1
+    stopped_at = None
+    for line, data in read_lines(request.stream,
+                                 app.config['IMPORT_MAX_LINE_LENGTH']):
+        if data is None:
+            fail(line, 'Line is too long')
+            continue
+        try:
+            data = loads(data)
+        except ValueError:
+            fail(line, 'Line is not valid JSON')
+            continue
+        url = data.get('url') if isinstance(data, dict) else None
+        if not (url and isinstance(url, str)):
+            fail(line, 'URL is required')
+            continue
+        if not trust_urls or not batch:
+            if credit:
+                credit -= 1
+            elif not take_create_tokens(1):
+                stopped_at = line
+                break
+        batch.append((line, url))
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    if stopped_at is not None:
+        return (jsonify(
+            error='Too Many Requests',
+            code='429',
+            message=('Rate limit exceeded. Lines from {} on were not '
+                     'imported. See the Retry-After header'
+                     .format(stopped_at)),
+            summary=summary
+        ), 429)
+    return jsonify(summary=summary)
 
 
 @app.route('/bookmarks/<bookmark_id>', methods=['GET'])
+@query_budget(3)
 @auth_required
+@conditional
 @verify_bookmark
 @is_authorized
 def single_bookmark(bookmark_id):
@@ -276,7 +744,45 @@ def single_bookmark(bookmark_id):
     return jsonify(bookmark=bookmark.json())
 
 
+@app.route('/bookmarks/<bookmark_id>/stats', methods=['GET'])
+@query_budget(3)
+@auth_required
+@verify_bookmark
+@is_authorized
+def bookmark_stats(bookmark_id):
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in GRANULARITIES:
+        return (jsonify(
+            error='Bad Request',
+            code='400',
+            message='Granularity must be one of {}'.format(
+                ', '.join(sorted(GRANULARITIES)))
+        ), 400)
+    # Range is given in unix time, and defaults to the last 24 hours (or 30
+    # days for daily stats)
+    try:
+        end = int(request.args.get('to', time.time()))
+        default_days = 1 if granularity == 'hour' else 30
+        start = int(request.args.get('from', end - default_days * 86400))
+    except ValueError:
+        return (jsonify(
+            error='Bad Request',
+            code='400',
+            message='From and to must be unix timestamps'
+        ), 400)
+    buckets = get_stats(bookmark_id, granularity, start, end)
+    return jsonify(stats={
+        'bookmark_id': bookmark_id,
+        'granularity': granularity,
+        'from': start,
+        'to': end,
+        'buckets': [{'start': bucket, 'hits': hits}
+                    for bucket, hits in buckets]
+    })
+
+
 @app.route('/users', methods=['GET', 'POST'])
+@query_budget(4)
 @super_auth_required
 def users():
     if request.method == 'POST':
@@ -286,18 +792,10 @@ def users():
         password = request.form.get('password')
         # Verify data sent
         if not (name and password and email):
-            return (jsonify(
-                error='Bad Request',
-                code='400',
-                message='Please check request data'
-            ), 400)
+            return BAD_USER_DATA()
         # Check if user exists with email address
         if User.query.filter(User.email == email).one_or_none():
-            return (jsonify(
-                error='Conflict',
-                code='409',
-                message='A user with this email already exists'
-            ), 409)
+            return USER_EXISTS()
         # Create user in database
         # Hash password
         password_hash = bcrypt.hashpw(
@@ -306,26 +804,33 @@ def users():
         ).decode('utf-8')
         u = User(name, email, password_hash)
         db_session.add(u)
+        # Flush to get user id, and build json before commit expires it
+        db_session.flush()
+        u_json = u.json()
         db_session.commit()
         # Craft response
         response = make_response(
             jsonify(
-                user=u.json()
+                user=u_json
             )
         )
         # Provide location of user resource
-        response.headers['Location'] = '/users/{}'.format(u.id)
+        response.headers['Location'] = '/users/{}'.format(u_json['id'])
         return response, 201
+    users = User.json_select().order_by(User.id)
+    # Stream all users
+    if stream_requested():
+        return stream_json('users', users, User.row_json)
     # Query users and return
-    users = User.query.all()
-    return jsonify(users=[u.json() for u in users])
+    return jsonify(users=[User.row_json(u) for u in db_session.execute(users)])
 
 
 @app.route('/users/<user_id>', methods=['GET'])
+@query_budget(2)
 @super_auth_required
 def single_user(user_id):
     # Query users
-    user = User.query.get(user_id)
+    user = get_fresh(User, user_id)
     if not user:
         return (jsonify(
             error='Not Found',
@@ -336,6 +841,7 @@ def single_user(user_id):
 
 
 @app.route('/api_keys', methods=['GET', 'POST'])
+@query_budget(4)
 @login_required
 def api_keys():
     if request.method == 'POST':
@@ -351,14 +857,19 @@ def api_keys():
             string.ascii_letters + string.digits) for _ in range(60))
         k = API_Key(id=k_id, secret=secret, user_id=g.user.id)
         db_session.add(k)
+        k_json = k.json()
         db_session.commit()
         # Craft response
         response = make_response(
             jsonify(
-                api_key=k.json()
+                api_key=k_json
             )
         )
         return response, 201
-    # Query api keys and return
-    api_keys = API_Key.query.filter_by(user_id=g.user.id).all()
-    return jsonify(api_keys=[k.json() for k in api_keys])
+    api_keys = API_Key.json_select().where(API_Key.user_id == g.user.id)
+    # Stream all api keys
+    if stream_requested():
+        return stream_json('api_keys', api_keys.order_by(API_Key.id),
+                           API_Key.row_json)
+    # Query a page of api keys and return
+    return page_response('api_keys', API_Key, api_keys, API_Key.id)
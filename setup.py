@@ -15,4 +15,10 @@ setup(
         'requests',
         'bcrypt'
     ],
+    extras_require={
+        # Faster json encoding of responses
+        'fast': ['orjson'],
+        # Brotli compression of responses
+        'brotli': ['brotli']
+    },
 )
@@ -3,9 +3,97 @@ import re
 import unittest
 import json
 import base64
+import gzip
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import bcrypt
+from sqlalchemy import create_engine, exc, inspect
 
 import bookmarks_service
-from bookmarks_service.models import SuperUser
+from bookmarks_service.analytics import (ClickCounter, add_stats,
+                                         bucket_start, click_counter,
+                                         compact_stats, roll_up_stats)
+from bookmarks_service.cache import caches
+from bookmarks_service.compression import brotli
+from bookmarks_service.database import InstrumentedQueuePool
+from bookmarks_service.ids import ID_SPACE, PermutationAllocator
+from bookmarks_service.metrics import (Counter as CounterMetric,
+                                       SnapshotStore, merge, metrics, render)
+from bookmarks_service.migrations import (hash_url_fragments, migrate,
+                                          migrations, set_version)
+from bookmarks_service.querylog import capture_queries
+from bookmarks_service.ratelimit import SQLiteBackend
+from bookmarks_service.serialization import get_backend, orjson
+from bookmarks_service.models import (SuperUser, User, Bookmark, API_Key,
+                                      IdCounter)
+from bookmarks_service.utils import url_hash
+from bookmarks_service.verification import URLVerifier, requeue_pending
+
+
+# Local server standing in for urls that bookmarks point to
+class TargetHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Method and path of each request made
+    requests = []
+
+    def do_HEAD(self):
+        self.requests.append(('HEAD', self.path))
+        # Server that does not support HEAD
+        if self.path == '/nohead':
+            self.respond(405)
+        else:
+            self.respond()
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path))
+        if self.path == '/nohead':
+            self.respond(200, b'x' * 1000000)
+        else:
+            self.respond()
+
+    def respond(self, status=None, body=b''):
+        if status:
+            self.send_response(status)
+        elif self.path == '/ok':
+            self.send_response(200)
+        elif self.path == '/slow':
+            time.sleep(0.5)
+            self.send_response(200)
+        elif self.path == '/redirect':
+            self.send_response(301)
+            self.send_header('Location', '/ok')
+        else:
+            self.send_response(404)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command == 'GET':
+            try:
+                self.wfile.write(body)
+            except OSError:
+                pass
+
+    def log_message(self, *args):
+        pass
+
+
+def setUpModule():
+    global target_server, TARGET_URL
+    target_server = ThreadingHTTPServer(('127.0.0.1', 0), TargetHandler)
+    threading.Thread(target=target_server.serve_forever, daemon=True).start()
+    TARGET_URL = 'http://127.0.0.1:{}'.format(target_server.server_port)
+
+
+def tearDownModule():
+    target_server.shutdown()
+    target_server.server_close()
 
 
 class BaseTestCase(unittest.TestCase):
@@ -13,6 +101,12 @@ class BaseTestCase(unittest.TestCase):
     def setUp(self):
         self.app = bookmarks_service.app.test_client()
         bookmarks_service.database.init_db()
+        # Start every test with empty caches
+        for cache in caches.values():
+            cache.clear()
+        click_counter.clear()
+        for metric in metrics.values():
+            metric.clear()
 
         self.create_super_user('12345')
 
@@ -22,6 +116,13 @@ class BaseTestCase(unittest.TestCase):
             bind=bookmarks_service.database.engine)
 
     # Helper functions for tests
+    @contextmanager
+    def assertQueries(self, count):
+        # Assert the with block makes exactly count database queries
+        with capture_queries() as log:
+            yield log
+        self.assertEqual(log.count, count, msg=log.summary())
+
     def create_user(self, name, email, password):
         rv = self.app.post(
             '/users',
@@ -59,6 +160,13 @@ class BaseTestCase(unittest.TestCase):
         rv = self.app.post('/api_keys', headers=headers)
         return rv
 
+    def add_bookmark_row(self, id, url, user_id, status='verified'):
+        # Insert bookmark directly, skipping url verification
+        b = Bookmark(id=id, url=url, user_id=user_id, status=status)
+        bookmarks_service.database.db_session.add(b)
+        bookmarks_service.database.db_session.commit()
+        return b
+
 
 class GeneralTestCase(BaseTestCase):
     def test_front_page(self):
@@ -67,6 +175,36 @@ class GeneralTestCase(BaseTestCase):
         self.assertEqual(rv.status_code, 200)
 
 
+class SerializationTestCase(BaseTestCase):
+    # Test json backends encode the same data
+    def test_backends(self):
+        data = {'b': [1, 2.5, None, True], 'a': {'u': 'caf\u00e9 \u2603'}}
+        backends = [get_backend('stdlib'), get_backend('auto')]
+        if orjson is not None:
+            backends.append(get_backend('orjson'))
+        for dumps in backends:
+            for pretty in (False, True):
+                body = dumps(data, pretty, True)
+                self.assertIsInstance(body, bytes)
+                self.assertEqual(json.loads(body.decode()), data)
+        self.assertEqual(get_backend('stdlib')(data, False, True),
+                         json.dumps(data, sort_keys=True,
+                                    separators=(',', ':')).encode())
+        with self.assertRaises(ValueError):
+            get_backend('yaml')
+
+    # Test precomputed error responses are the same on every request
+    def test_precomputed_error(self):
+        first = self.app.get('/bookmarks')
+        second = self.app.get('/bookmarks')
+        self.assertEqual(first.status_code, 401)
+        self.assertEqual(first.mimetype, 'application/json')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(json.loads(first.data.decode()), {
+            'error': 'Unauthorized', 'code': '401',
+            'message': 'You must include a proper authorization header'})
+
+
 class SuperAdminTestCase(BaseTestCase):
     # Test for super user authorization
     def test_bookmark_auth_required(self):
@@ -82,6 +220,23 @@ class SuperAdminTestCase(BaseTestCase):
         rv = self.app.get('/users', headers=self.super_user_headers)
         self.assertIn(b'{\n  "users": []\n}\n', rv.data)
 
+    # Test streaming all users
+    def test_stream_users(self):
+        for i in range(3):
+            self.create_user('User', 'user{}@me.com'.format(i), 'password')
+        rv = self.app.get('/users?stream=True',
+                          headers=self.super_user_headers)
+        self.assertEqual(rv.status_code, 200)
+        users = json.loads(rv.data.decode())['users']
+        self.assertEqual([u['email'] for u in users],
+                         ['user{}@me.com'.format(i) for i in range(3)])
+
+    # Test streaming with no users is still valid json
+    def test_stream_no_users(self):
+        rv = self.app.get('/users?stream=True',
+                          headers=self.super_user_headers)
+        self.assertEqual(json.loads(rv.data.decode()), {'users': []})
+
     # Test creating a new user
     def test_create_user(self):
         # Create user
@@ -162,6 +317,89 @@ class SuperAdminTestCase(BaseTestCase):
             )
 
 
+class PoolTestCase(BaseTestCase):
+    # Test pool records checkouts and timeouts
+    def test_instrumented_pool(self):
+        pool = InstrumentedQueuePool(
+            lambda: sqlite3.connect(':memory:'),
+            pool_size=1, max_overflow=0, timeout=0.1)
+        conn = pool.connect()
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        stats = pool.stats()
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['max_wait'], 0.1)
+        conn.close()
+        self.assertEqual(pool.stats()['checked_out'], 0)
+
+    # Test pool stats are reported
+    def test_pool_stats(self):
+        rv = self.app.get('/stats', headers=self.super_user_headers)
+        self.assertIn('pool', json.loads(rv.data.decode())['stats'])
+
+
+class MetricsTestCase(BaseTestCase):
+    # Test requests, password checks and queries are reported
+    def test_metrics(self):
+        self.app.get('/users')
+        rv = self.app.get('/metrics', headers=self.super_user_headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertTrue(rv.content_type.startswith('text/plain'))
+        text = rv.data.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_requests_total{method="GET",route="/users",'
+                      'status="401"} 1', text)
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/users"} 1', text)
+        self.assertIn('bcrypt_check_duration_seconds_count 1', text)
+        self.assertIn('db_queries_total{database="primary",'
+                      'operation="SELECT"}', text)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",'
+                      'route="/users",le="+Inf"} 1', text)
+
+    # Test snapshots of several processes are added up
+    def test_metrics_snapshots(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.db')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        store = SnapshotStore(path, interval=60)
+        counter = metrics['url_verifications_total']
+        counter.inc(outcome='ok')
+        # Snapshot of another process
+        store.connection().execute(
+            'INSERT INTO metric_snapshots VALUES (?, ?, ?, ?)',
+            ('other', 0, 0,
+             json.dumps({counter.name: [[[['outcome', 'ok']], 2]]})))
+        text = render(merge(store.read()))
+        self.assertIn('url_verifications_total{outcome="ok"} 3', text)
+
+    # Test a process reusing the pid of one that exited keeps its totals
+    def test_metrics_pid_reused(self):
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.db')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        counter = metrics['url_verifications_total']
+        counter.inc(5, outcome='ok')
+        SnapshotStore(path, interval=60).write()
+        # Process that exited, with this pid
+        counter.clear()
+        counter.inc(outcome='ok')
+        store = SnapshotStore(path, interval=60)
+        for _ in range(2):
+            text = render(merge(store.read()))
+            self.assertIn('url_verifications_total{outcome="ok"} 6', text)
+        self.assertEqual(store.connection().execute(
+            'SELECT COUNT(*) FROM metric_snapshots').fetchone()[0], 2)
+
+    # Test metric output is escaped
+    def test_metric_labels(self):
+        counter = CounterMetric('test_total', 'Test counter')
+        self.addCleanup(metrics.pop, 'test_total')
+        counter.inc(2, path='a"b\\c')
+        self.assertIn('test_total{path="a\\"b\\\\c"} 2',
+                      render(merge([{'test_total': counter.snapshot()}])))
+
+
 class APIKeyTestCase(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -221,6 +459,24 @@ class APIKeyTestCase(BaseTestCase):
         )
         self.assertEqual(rv.status_code, 401)
 
+    # Test repeated logins skip bcrypt until password changes
+    def test_credential_cache(self):
+        for _ in range(3):
+            rv = self.app.get('/api_keys', headers=self.headers)
+            self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/stats', headers=self.super_user_headers)
+        stats = json.loads(rv.data.decode())['stats']['caches']
+        # Two repeated user logins, and the repeated super user login
+        self.assertEqual(stats['credentials']['hits'], 3)
+        # Change password
+        db_session = bookmarks_service.database.db_session
+        user = db_session.query(User).get(self.user_id)
+        user.password_hash = bcrypt.hashpw(
+            b'New!Password', bcrypt.gensalt()).decode('utf-8')
+        db_session.commit()
+        rv = self.app.get('/api_keys', headers=self.headers)
+        self.assertEqual(rv.status_code, 401)
+
     # Test for no api keys
     def test_no_api_keys(self):
         rv = self.app.get(
@@ -267,6 +523,18 @@ class APIKeyTestCase(BaseTestCase):
         api_keys_2 = json.loads(rv.data.decode())['api_keys']
         self.assertEqual(len(api_keys_2), 2)
 
+    # Test paging through api keys
+    def test_api_keys_pagination(self):
+        for _ in range(3):
+            self.create_api_key(headers=self.headers)
+        rv = self.app.get('/api_keys?limit=2', headers=self.headers)
+        data = json.loads(rv.data.decode())
+        self.assertEqual(len(data['api_keys']), 2)
+        rv = self.app.get(data['next'], headers=self.headers)
+        data_2 = json.loads(rv.data.decode())
+        self.assertEqual(len(data_2['api_keys']), 1)
+        self.assertNotIn('next', data_2)
+
 
 class BookmarksTestCase(BaseTestCase):
     # TODO: Fix these up a bit. messy.
@@ -281,6 +549,7 @@ class BookmarksTestCase(BaseTestCase):
         )
         # Store user ID for later
         user_id = json.loads(rv.data.decode())['user']['id']
+        self.user_id = user_id
         # Create a user authorization header
         user_auth_value = "{}:{}".format(user_id, password)
         user_auth = base64.b64encode(user_auth_value.encode())
@@ -344,6 +613,23 @@ class BookmarksTestCase(BaseTestCase):
         )
         self.assertEqual(rv.status_code, 401)
 
+    # Test api keys are cached, and dropped from cache when changed
+    def test_api_key_cache(self):
+        for _ in range(3):
+            rv = self.app.get('/bookmarks', headers=self.headers)
+            self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/stats', headers=self.super_user_headers)
+        stats = json.loads(rv.data.decode())['stats']['caches']
+        self.assertEqual(stats['api_keys']['misses'], 1)
+        self.assertEqual(stats['api_keys']['hits'], 2)
+        # Change secret
+        db_session = bookmarks_service.database.db_session
+        api_key = db_session.query(API_Key).get(self.api_key)
+        api_key.secret = 'New Secret'
+        db_session.commit()
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual(rv.status_code, 401)
+
     # Test for no bookmarks
     def test_no_bookmarks(self):
         rv = self.app.get(
@@ -435,6 +721,316 @@ class BookmarksTestCase(BaseTestCase):
             'Bookmark get failed'
         )
 
+    # Wait for a bookmark to leave the pending state and return it
+    def wait_for_verification(self, location):
+        for _ in range(50):
+            rv = self.app.get(location, headers=self.headers)
+            bookmark = json.loads(rv.data.decode())['bookmark']
+            if bookmark['status'] != 'pending':
+                return bookmark
+            time.sleep(0.1)
+        self.fail('Bookmark was not verified in the background')
+
+    # Test creating bookmarks with async verification
+    def test_async_bookmark(self):
+        rv = self.app.post(
+            '/bookmarks',
+            data={'url': TARGET_URL + '/redirect', 'async': 'True',
+                  'follow_redirects': 'True'},
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 202)
+        self.assertEqual(
+            json.loads(rv.data.decode())['bookmark']['status'], 'pending')
+        bookmark = self.wait_for_verification(rv.headers['Location'])
+        self.assertEqual(bookmark['status'], 'verified')
+        self.assertEqual(bookmark['url'], TARGET_URL + '/ok')
+        # Bookmark that fails verification
+        rv = self.app.post(
+            '/bookmarks',
+            data={'url': TARGET_URL + '/missing', 'async': 'True'},
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 202)
+        bookmark = self.wait_for_verification(rv.headers['Location'])
+        self.assertEqual(bookmark['status'], 'failed')
+        self.assertIn('404 Client Error', bookmark['error'])
+
+    # Test bookmarks left pending by a process that died are verified again
+    def test_requeue_pending(self):
+        now = time.time()
+        stale = self.add_bookmark_row('abc123', TARGET_URL + '/redirect',
+                                      self.user_id, status='pending')
+        stale.pending_since = int(now) - 7200
+        stale.follow_redirects = True
+        self.add_bookmark_row('abc124', TARGET_URL + '/ok', self.user_id,
+                              status='pending')
+        bookmarks_service.database.db_session.commit()
+        futures = requeue_pending(now)
+        self.assertEqual(len(futures), 1)
+        for future in futures:
+            future.result()
+        # Redirects are followed as when it was first queued
+        rv = self.app.get('/bookmarks/abc123', headers=self.headers)
+        bookmark = json.loads(rv.data.decode())['bookmark']
+        self.assertEqual(bookmark['status'], 'verified')
+        self.assertEqual(bookmark['url'], TARGET_URL + '/ok')
+        # Recently queued bookmarks are left alone
+        rv = self.app.get('/bookmarks/abc124', headers=self.headers)
+        self.assertEqual(json.loads(rv.data.decode())['bookmark']['status'],
+                         'pending')
+        self.assertEqual(requeue_pending(now), [])
+        # Only one process queues each stale bookmark
+        bookmarks_service.database.db_session.query(Bookmark).filter(
+            Bookmark.id == 'abc124').update({'pending_since': 0})
+        bookmarks_service.database.db_session.commit()
+        futures = requeue_pending(now)
+        self.assertEqual(len(futures), 1)
+        self.assertEqual(requeue_pending(now), [])
+        futures[0].result()
+
+    # Test urls are verified with HEAD, falling back to GET
+    def test_verify_head_fallback(self):
+        del TargetHandler.requests[:]
+        rv = self.create_bookmark(TARGET_URL + '/ok')
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(TargetHandler.requests, [('HEAD', '/ok')])
+        del TargetHandler.requests[:]
+        rv = self.create_bookmark(TARGET_URL + '/nohead')
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(TargetHandler.requests,
+                         [('HEAD', '/nohead'), ('GET', '/nohead')])
+
+    # Test verifications do not wait for a connection to a busy host
+    def test_verify_busy_host(self):
+        verifier = URLVerifier('test', timeout=5, max_hosts=1,
+                               max_per_host=1, max_bytes=0)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(2) as pool:
+            results = list(pool.map(verifier.verify,
+                                    [TARGET_URL + '/slow'] * 2))
+        self.assertEqual(results, [(TARGET_URL + '/slow', None)] * 2)
+        # Both were made at once, taking the time of one
+        self.assertLess(time.perf_counter() - start, 0.9)
+
+    def test_verify_cache(self):
+        del TargetHandler.requests[:]
+        for _ in range(2):
+            self.create_bookmark(TARGET_URL + '/ok')
+            self.create_bookmark(TARGET_URL.upper() + '/ok')
+            rv = self.create_bookmark(TARGET_URL + '/missing')
+            self.assertEqual(rv.status_code, 400)
+        self.assertEqual(
+            sorted(set(TargetHandler.requests)),
+            [('GET', '/missing'), ('HEAD', '/missing'), ('HEAD', '/ok')])
+        self.assertEqual(len(TargetHandler.requests), 3)
+        # Outcomes of verifications made are counted
+        outcomes = dict(metrics['url_verifications_total'].values)
+        self.assertEqual(outcomes, {(('outcome', 'ok'),): 1,
+                                    (('outcome', 'HTTPError'),): 1})
+        # Urls that only differ in fragment are verified separately, and
+        # each keeps its own fragment
+        for fragment in ('#private-token', '#section-2', '#private-token'):
+            rv = self.create_bookmark(TARGET_URL + '/ok' + fragment)
+            self.assertEqual(json.loads(rv.data.decode())['bookmark']['url'],
+                             TARGET_URL + '/ok' + fragment)
+        self.assertEqual(len(TargetHandler.requests), 5)
+
+    # Test concurrent verifications of a url share one request
+    def test_verify_in_flight(self):
+        del TargetHandler.requests[:]
+        rv = self.app.post(
+            '/bookmarks/batch',
+            data={'url': [TARGET_URL + '/ok'] * 5},
+            headers=self.headers
+        )
+        results = json.loads(rv.data.decode())['results']
+        self.assertEqual(len([r for r in results if 'bookmark' in r]), 5)
+        self.assertEqual(TargetHandler.requests, [('HEAD', '/ok')])
+
+    # Test bookmarking the same url again returns existing bookmark
+    def test_dedup_bookmarks(self):
+        bookmarks_service.app.config['DEDUPLICATE_BOOKMARKS'] = True
+        self.addCleanup(bookmarks_service.app.config.__setitem__,
+                        'DEDUPLICATE_BOOKMARKS', False)
+        rv = self.create_bookmark(TARGET_URL + '/ok')
+        self.assertEqual(rv.status_code, 201)
+        bookmark = json.loads(rv.data.decode())['bookmark']
+        # Same url, and one that redirects to it
+        del TargetHandler.requests[:]
+        rv = self.create_bookmark(TARGET_URL.upper() + '/ok')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data.decode())['bookmark'], bookmark)
+        self.assertEqual(TargetHandler.requests, [])
+        # Another fragment is another bookmark, which keeps its fragment
+        rv = self.create_bookmark(TARGET_URL + '/ok#top')
+        self.assertEqual(rv.status_code, 201)
+        self.assertEqual(json.loads(rv.data.decode())['bookmark']['url'],
+                         TARGET_URL + '/ok#top')
+        rv = self.create_bookmark(TARGET_URL.upper() + '/ok#top')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data.decode())['bookmark']['url'],
+                         TARGET_URL + '/ok#top')
+        rv = self.create_bookmark(TARGET_URL + '/redirect',
+                                  follow_redirects='True')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Location'].split('/')[-1],
+                         bookmark['id'])
+        # Batch with duplicates
+        rv = self.app.post(
+            '/bookmarks/batch',
+            data={'url': [TARGET_URL + '/ok', TARGET_URL + '/nohead',
+                          TARGET_URL + '/nohead']},
+            headers=self.headers
+        )
+        results = json.loads(rv.data.decode())['results']
+        self.assertEqual(results[0]['bookmark'], bookmark)
+        self.assertEqual(results[1]['bookmark'], results[2]['bookmark'])
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual(len(json.loads(rv.data.decode())['bookmarks']), 3)
+
+    # Test reads go to replica, except a client's reads after writing
+    @unittest.skipUnless(
+        bookmarks_service.database.engine.url.drivername == 'sqlite' and
+        bookmarks_service.database.engine.url.database,
+        'Replica test needs a SQLite file database')
+    def test_read_replica(self):
+        database = bookmarks_service.database
+        # Replica is a copy of the primary database file
+        replica = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        shutil.copy(database.engine.url.database, replica)
+        database.replica_engine = create_engine('sqlite:///' + replica)
+        self.addCleanup(setattr, database, 'replica_engine', None)
+        # Added to primary, but not replicated yet
+        self.add_bookmark_row('abc123', TARGET_URL + '/ok', self.user_id)
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual(json.loads(rv.data.decode())['bookmarks'], [])
+        # Single bookmark falls back to primary when not on replica
+        rv = self.app.get('/bookmarks/abc123', headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        # Client that just wrote reads from primary
+        self.create_bookmark(TARGET_URL + '/ok')
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual(len(json.loads(rv.data.decode())['bookmarks']), 2)
+
+    # Test new users and api keys can authenticate before they are replicated
+    @unittest.skipUnless(
+        bookmarks_service.database.engine.url.drivername == 'sqlite' and
+        bookmarks_service.database.engine.url.database,
+        'Replica test needs a SQLite file database')
+    def test_auth_replica_lag(self):
+        database = bookmarks_service.database
+        replica = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        shutil.copy(database.engine.url.database, replica)
+        database.replica_engine = create_engine('sqlite:///' + replica)
+        self.addCleanup(setattr, database, 'replica_engine', None)
+        # User and api key are only on the primary
+        rv = self.create_user('Jane Smith', 'jane@me.com', 'Jane!Pass22')
+        self.assertEqual(rv.status_code, 201)
+        user_id = json.loads(rv.data.decode())['user']['id']
+        auth = base64.b64encode('{}:{}'.format(user_id, 'Jane!Pass22')
+                                .encode())
+        rv = self.create_api_key({'Authorization': b'Basic ' + auth})
+        self.assertEqual(rv.status_code, 201)
+        api_key = json.loads(rv.data.decode())['api_key']
+        auth = base64.b64encode('{}:{}'.format(api_key['id'],
+                                               api_key['secret']).encode())
+        headers = {'Authorization': b'Basic ' + auth}
+        rv = self.app.get('/bookmarks', headers=headers)
+        self.assertEqual(rv.status_code, 200)
+        # Wrong secret is still refused
+        auth = base64.b64encode('{}:x'.format(api_key['id']).encode())
+        rv = self.app.get('/bookmarks',
+                          headers={'Authorization': b'Basic ' + auth})
+        self.assertEqual(rv.status_code, 401)
+
+    # Test creating several bookmarks at once
+    def test_batch_bookmarks(self):
+        urls = [TARGET_URL + '/ok', TARGET_URL + '/missing',
+                TARGET_URL + '/redirect']
+        rv = self.app.post(
+            '/bookmarks/batch',
+            data=json.dumps({'urls': urls, 'follow_redirects': True}),
+            content_type='application/json',
+            headers=self.headers
+        )
+        self.assertEqual(rv.status_code, 200)
+        results = json.loads(rv.data.decode())['results']
+        self.assertEqual([r['url'] for r in results], urls)
+        self.assertEqual(results[0]['bookmark']['url'], TARGET_URL + '/ok')
+        self.assertIn('404 Client Error', results[1]['error']['message'])
+        self.assertEqual(results[2]['bookmark']['url'], TARGET_URL + '/ok')
+        # Only verified urls were saved
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual(len(json.loads(rv.data.decode())['bookmarks']), 2)
+
+    # Test batch creation with form data and errors
+    def test_batch_bookmarks_errors(self):
+        rv = self.app.post('/bookmarks/batch', headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn(b'A list of URLs is required', rv.data)
+        rv = self.app.post(
+            '/bookmarks/batch',
+            data={'url': [TARGET_URL + '/ok', 'http://127.0.0.1:1/']},
+            headers=self.headers
+        )
+        results = json.loads(rv.data.decode())['results']
+        self.assertIn('bookmark', results[0])
+        self.assertIn('Could not connect to your url',
+                      results[1]['error']['message'])
+
+    # Test paging through bookmarks with limit and after cursor
+    def test_bookmarks_pagination(self):
+        ids = ['abc12{}'.format(i) for i in range(5)]
+        for b_id in ids:
+            self.add_bookmark_row(b_id, 'http://www.google.com/',
+                                  self.user_id)
+        seen = []
+        url = '/bookmarks?limit=2'
+        while url:
+            rv = self.app.get(url, headers=self.headers)
+            self.assertEqual(rv.status_code, 200)
+            data = json.loads(rv.data.decode())
+            self.assertLessEqual(len(data['bookmarks']), 2)
+            seen.extend(b['id'] for b in data['bookmarks'])
+            url = data.get('next')
+        self.assertEqual(seen, ids)
+
+    # Test streaming all bookmarks ignores page size
+    def test_stream_bookmarks(self):
+        for i in range(5):
+            self.add_bookmark_row('abc12{}'.format(i),
+                                  'http://www.google.com/', self.user_id)
+        rv = self.app.get('/bookmarks?stream=True&limit=2',
+                          headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.data.decode())
+        self.assertEqual(len(data['bookmarks']), 5)
+        self.assertNotIn('next', data)
+
+    # Test listed bookmarks match single bookmarks
+    def test_list_matches_get(self):
+        b = self.add_bookmark_row('abc123', TARGET_URL + '/missing',
+                                  self.user_id, status='failed')
+        b.error = 'Not found'
+        bookmarks_service.database.db_session.commit()
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        listed = json.loads(rv.data.decode())['bookmarks']
+        rv = self.app.get('/bookmarks/abc123', headers=self.headers)
+        self.assertEqual(listed, [json.loads(rv.data.decode())['bookmark']])
+        self.assertEqual(listed[0]['error'], 'Not found')
+
+    # Test pagination argument errors
+    def test_bookmarks_pagination_errors(self):
+        rv = self.app.get('/bookmarks?limit=0', headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn(b'Limit must be between 1 and', rv.data)
+        rv = self.app.get('/bookmarks?limit=ten', headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.get('/bookmarks?after=%%%', headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn(b'Invalid after cursor', rv.data)
+
     # Test bookmark retrieval errors
     def test_get_bookmark_errors(self):
         # Use incorrect bookmark id format
@@ -454,6 +1050,636 @@ class BookmarksTestCase(BaseTestCase):
             'Bookmark get error message is not correct'
         )
 
+    # Test api keys are rate limited, with separate read and create budgets
+    def test_rate_limit(self):
+        config = bookmarks_service.app.config
+        for setting, value in (('RATE_LIMIT_READ_RATE', 0.01),
+                               ('RATE_LIMIT_READ_BURST', 2)):
+            self.addCleanup(config.__setitem__, setting, config[setting])
+            config[setting] = value
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['RateLimit-Limit'], '2')
+        self.assertEqual(rv.headers['RateLimit-Remaining'], '1')
+        self.app.get('/bookmarks', headers=self.headers)
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual(rv.status_code, 429)
+        self.assertEqual(rv.headers['RateLimit-Remaining'], '0')
+        self.assertGreater(int(rv.headers['Retry-After']), 0)
+        # Creating has its own budget
+        rv = self.app.post('/bookmarks', headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn('RateLimit-Remaining', rv.headers)
+
+    # Test batches and imports take a create token for each url verified
+    def test_rate_limit_many_urls(self):
+        config = bookmarks_service.app.config
+        for setting, value in (('RATE_LIMIT_CREATE_RATE', 0.01),
+                               ('RATE_LIMIT_CREATE_BURST', 5),
+                               ('IMPORT_BATCH_SIZE', 2)):
+            self.addCleanup(config.__setitem__, setting, config[setting])
+            config[setting] = value
+        urls = [TARGET_URL + '/ok#{}'.format(i) for i in range(6)]
+        # Batches bigger than the burst could never be allowed
+        rv = self.app.post('/bookmarks/batch', data={'url': urls},
+                           headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        self.assertIn(b'At most 5 URLs', rv.data)
+        rv = self.app.post('/bookmarks/batch', data={'url': urls[:4]},
+                           headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['RateLimit-Remaining'], '0')
+        rv = self.app.post('/bookmarks/batch', data={'url': urls[:2]},
+                           headers=self.headers)
+        self.assertEqual(rv.status_code, 429)
+        self.assertGreater(int(rv.headers['Retry-After']), 0)
+        # Imports stop at the first url the rate limit can not cover
+        caches['rate_limits'].clear()
+        body = '\n'.join(json.dumps({'url': url}) for url in urls)
+        rv = self.app.post('/bookmarks/import', data=body,
+                           headers=self.headers)
+        self.assertEqual(rv.status_code, 429)
+        self.assertIn('Retry-After', rv.headers)
+        data = json.loads(rv.data.decode())
+        self.assertIn('Lines from 6 on were not imported', data['message'])
+        self.assertEqual(data['summary']['created'], 5)
+        # Trusted urls take a token per batch
+        caches['rate_limits'].clear()
+        body = '\n'.join(json.dumps({'url': 'http://www.google.com/{}'.format(
+            i)}) for i in range(12))
+        rv = self.app.post('/bookmarks/import?trust_urls=True', data=body,
+                           headers=self.headers)
+        self.assertEqual(rv.status_code, 429)
+        self.assertEqual(json.loads(rv.data.decode())['summary']['created'],
+                         10)
+
+    # Test SQLite rate limits are shared by backends using the same file
+    def test_rate_limit_shared(self):
+        path = os.path.join(tempfile.mkdtemp(), 'limits.db')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        first, second = SQLiteBackend(path), SQLiteBackend(path)
+        self.assertTrue(first.take('read:a', rate=0.01, burst=2).allowed)
+        self.assertTrue(second.take('read:a', rate=0.01, burst=2).allowed)
+        limit = first.take('read:a', rate=0.01, burst=2)
+        self.assertFalse(limit.allowed)
+        self.assertGreater(limit.retry_after, 0)
+        # Other keys have their own buckets
+        self.assertTrue(second.take('read:b', rate=0.01, burst=2).allowed)
+        second.prune('read:', 0)
+        self.assertTrue(first.take('read:a', rate=0.01, burst=2).allowed)
+
+    # Test bookmark responses have ETags, which change when bookmarks do
+    def test_etags(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        etag = rv.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        conditional = dict(self.headers, **{'If-None-Match': etag})
+        rv = self.app.get('/bookmarks', headers=conditional)
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.data, b'')
+        self.assertEqual(rv.headers['ETag'], etag)
+        # Each page, and each bookmark, has its own ETag
+        rv = self.app.get('/bookmarks?limit=1', headers=conditional)
+        self.assertEqual(rv.status_code, 200)
+        rv = self.app.get('/bookmarks/abc123', headers=conditional)
+        self.assertEqual(rv.status_code, 200)
+        bookmark_etag = rv.headers['ETag']
+        self.assertNotEqual(bookmark_etag, etag)
+        # Creating a bookmark changes ETags
+        self.create_bookmark(TARGET_URL + '/ok')
+        rv = self.app.get('/bookmarks', headers=conditional)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(json.loads(rv.data.decode())['bookmarks']), 2)
+        rv = self.app.get('/bookmarks/abc123', headers=dict(
+            self.headers, **{'If-None-Match': bookmark_etag}))
+        self.assertEqual(rv.status_code, 200)
+        # So do clicks, as hits are part of bookmark json
+        etag = rv.headers['ETag']
+        self.app.get('/abc123')
+        click_counter.flush()
+        rv = self.app.get('/bookmarks/abc123', headers=dict(
+            self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(json.loads(rv.data.decode())['bookmark']['hits'], 1)
+        # Errors get no ETag
+        rv = self.app.get('/bookmarks/a1b2c3', headers=self.headers)
+        self.assertNotIn('ETag', rv.headers)
+
+    # Test json responses are compressed when large enough
+    def test_compression(self):
+        for i in range(50):
+            self.add_bookmark_row('abc{:03d}'.format(i),
+                                  'http://www.google.com/{}'.format(i),
+                                  self.user_id)
+        plain = self.app.get('/bookmarks', headers=self.headers)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        gzip_headers = dict(self.headers, **{'Accept-Encoding': 'gzip'})
+        rv = self.app.get('/bookmarks', headers=gzip_headers)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        self.assertEqual(int(rv.headers['Content-Length']), len(rv.data))
+        self.assertLess(len(rv.data), len(plain.data) / 4)
+        self.assertEqual(gzip.decompress(rv.data), plain.data)
+        # Compressed response has its own ETag, which is still matched
+        etag = rv.headers['ETag']
+        self.assertEqual(etag, plain.headers['ETag'][:-1] + '-gzip"')
+        rv = self.app.get('/bookmarks', headers=dict(
+            gzip_headers, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers['ETag'], etag)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        # Encodings the client refuses, or does not know, are not used
+        rv = self.app.get('/bookmarks', headers=dict(
+            self.headers, **{'Accept-Encoding': 'gzip;q=0, compress'}))
+        self.assertNotIn('Content-Encoding', rv.headers)
+        # Small responses are not compressed
+        rv = self.app.get('/bookmarks/abc000', headers=gzip_headers)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        # Neither are errors
+        rv = self.app.get('/bookmarks/a1b2c3', headers=gzip_headers)
+        self.assertNotIn('Content-Encoding', rv.headers)
+
+    # Test streamed responses are compressed as they are sent
+    def test_compressed_stream(self):
+        bookmarks_service.app.config['STREAM_BATCH_SIZE'] = 10
+        self.addCleanup(bookmarks_service.app.config.__setitem__,
+                        'STREAM_BATCH_SIZE', 500)
+        for i in range(25):
+            self.add_bookmark_row('abc{:03d}'.format(i),
+                                  'http://www.google.com/{}'.format(i),
+                                  self.user_id)
+        plain = self.app.get('/bookmarks?stream=True',
+                             headers=self.headers).data
+        rv = self.app.get('/bookmarks?stream=True', headers=dict(
+            self.headers, **{'Accept-Encoding': 'gzip'}))
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', rv.headers)
+        # Each batch is flushed on its own
+        chunks = list(rv.response)
+        self.assertGreater(len(chunks), 3)
+        self.assertEqual(gzip.decompress(b''.join(chunks)), plain)
+
+    # Test brotli is preferred over gzip when installed
+    @unittest.skipUnless(brotli, 'brotli is not installed')
+    def test_brotli_compression(self):
+        for i in range(50):
+            self.add_bookmark_row('abc{:03d}'.format(i),
+                                  'http://www.google.com/{}'.format(i),
+                                  self.user_id)
+        plain = self.app.get('/bookmarks', headers=self.headers)
+        rv = self.app.get('/bookmarks', headers=dict(
+            self.headers, **{'Accept-Encoding': 'gzip, deflate, br'}))
+        self.assertEqual(rv.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(rv.data), plain.data)
+
+    # Test bookmarks are exported as newline delimited json
+    def test_export(self):
+        rv = self.app.get('/bookmarks/export')
+        self.assertEqual(rv.status_code, 401)
+        self.add_bookmark_row('abc124', 'http://www.github.com/',
+                              self.user_id)
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        # Another user's bookmark
+        self.add_bookmark_row('abc125', 'http://www.python.org/',
+                              self.user_id + 1)
+        with self.assertQueries(2):
+            rv = self.app.get('/bookmarks/export', headers=self.headers)
+            lines = rv.data.decode().splitlines()
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'application/x-ndjson')
+        self.assertIn('attachment', rv.headers['Content-Disposition'])
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'hits': 0, 'id': 'abc123', 'status': 'verified',
+             'url': 'http://www.google.com/', 'user_id': self.user_id},
+            {'hits': 0, 'id': 'abc124', 'status': 'verified',
+             'url': 'http://www.github.com/', 'user_id': self.user_id}])
+
+    # Test trusted urls are imported in batches without being verified
+    def test_import_trusted(self):
+        bookmarks_service.app.config['IMPORT_BATCH_SIZE'] = 2
+        self.addCleanup(bookmarks_service.app.config.__setitem__,
+                        'IMPORT_BATCH_SIZE', 500)
+        body = '\n'.join([
+            json.dumps({'url': 'http://www.google.com/'}),
+            '',
+            'not json',
+            json.dumps({'url': 'http://www.github.com/', 'id': 'abc123'}),
+            json.dumps({'name': 'No url'}),
+            json.dumps({'url': TARGET_URL + '/missing'}),
+            json.dumps({'url': 'x' * 70000}),
+            json.dumps({'url': ' HTTP://WWW.Python.org:80'}),
+            json.dumps({'url': 'javascript:alert(1)'}),
+            json.dumps({'url': 'not a url'}),
+            json.dumps({'url': 'http:///path'})])
+        del TargetHandler.requests[:]
+        rv = self.app.post('/bookmarks/import?trust_urls=True', data=body,
+                           headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        summary = json.loads(rv.data.decode())['summary']
+        self.assertEqual(summary['created'], 4)
+        self.assertEqual(summary['existing'], 0)
+        self.assertEqual(summary['failed'], 6)
+        self.assertEqual(summary['errors'][:3], [
+            {'line': 3, 'message': 'Line is not valid JSON'},
+            {'line': 5, 'message': 'URL is required'},
+            {'line': 7, 'message': 'Line is too long'}])
+        # Trusted urls must still be web urls
+        self.assertEqual(
+            [(e['line'], e['url']) for e in summary['errors'][3:]],
+            [(9, 'javascript:alert(1)'), (10, 'not a url'),
+             (11, 'http:///path')])
+        self.assertEqual(TargetHandler.requests, [])
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        bookmarks = json.loads(rv.data.decode())['bookmarks']
+        self.assertEqual(sorted(b['url'] for b in bookmarks), sorted([
+            'http://www.github.com/', 'http://www.google.com/',
+            'http://www.python.org/', TARGET_URL + '/missing']))
+        # Ids in the upload are not kept
+        self.assertNotIn('abc123', [b['id'] for b in bookmarks])
+        self.assertTrue(all(b['status'] == 'verified' for b in bookmarks))
+
+    # Test imported urls are verified, and exports can be imported again
+    def test_import_verified(self):
+        bookmarks_service.app.config['DEDUPLICATE_BOOKMARKS'] = True
+        self.addCleanup(bookmarks_service.app.config.__setitem__,
+                        'DEDUPLICATE_BOOKMARKS', False)
+        self.add_bookmark_row('abc123', TARGET_URL + '/ok', self.user_id)
+        exported = self.app.get('/bookmarks/export',
+                                headers=self.headers).data
+        body = exported + '\n'.join([
+            json.dumps({'url': TARGET_URL + '/redirect'}),
+            json.dumps({'url': TARGET_URL + '/missing'}),
+            json.dumps({'url': 'http://www.python.org:1/'})]).encode()
+        rv = self.app.post('/bookmarks/import?follow_redirects=True',
+                           data=body, headers=self.headers)
+        summary = json.loads(rv.data.decode())['summary']
+        # Redirect leads to the bookmark that already exists
+        self.assertEqual(summary['created'], 0)
+        self.assertEqual(summary['existing'], 2)
+        self.assertEqual(summary['failed'], 2)
+        self.assertEqual([(e['line'], e['url']) for e in summary['errors']],
+                         [(3, TARGET_URL + '/missing'),
+                          (4, 'http://www.python.org:1/')])
+        bookmarks_service.app.config['DEDUPLICATE_BOOKMARKS'] = False
+        rv = self.app.post('/bookmarks/import?follow_redirects=True',
+                           data=body, headers=self.headers)
+        summary = json.loads(rv.data.decode())['summary']
+        self.assertEqual(summary['created'], 2)
+        rv = self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual([b['url'] for b in json.loads(
+            rv.data.decode())['bookmarks']], [TARGET_URL + '/ok'] * 3)
+
+    # Test number of queries each bookmark endpoint makes
+    def test_bookmark_query_counts(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        # Loading the api key and user is a single query, then cached.
+        # Reading the bookmarks version for the ETag is another.
+        with self.assertQueries(3):
+            self.app.get('/bookmarks', headers=self.headers)
+        with self.assertQueries(2):
+            self.app.get('/bookmarks', headers=self.headers)
+        with self.assertQueries(2):
+            self.app.get('/bookmarks?stream=True', headers=self.headers).data
+        # Bookmark is loaded once for both verify_bookmark and is_authorized
+        with self.assertQueries(2):
+            rv = self.app.get('/bookmarks/abc123', headers=self.headers)
+        # Only the version is read when the client has the latest ETag
+        with self.assertQueries(1):
+            self.app.get('/bookmarks/abc123', headers=dict(
+                self.headers, **{'If-None-Match': rv.headers['ETag']}))
+        with self.assertQueries(2):
+            self.app.get('/bookmarks/abc123/stats', headers=self.headers)
+        # Created bookmark is not loaded again for the response
+        with self.assertQueries(3):
+            rv = self.app.post('/bookmarks', headers=self.headers,
+                               data={'url': TARGET_URL + '/ok',
+                                     'async': 'True'})
+        self.assertEqual(rv.status_code, 202)
+        with self.assertQueries(1):
+            self.app.get('/abc123')
+        with self.assertQueries(0):
+            self.app.get('/abc123')
+
+    # Test requests over their query budget log a warning in debug mode
+    def test_query_budget(self):
+        flask_app = bookmarks_service.app
+        view = flask_app.view_functions['bookmarks']
+        self.addCleanup(setattr, flask_app, 'debug', flask_app.debug)
+        self.addCleanup(setattr, view, 'query_budget', view.query_budget)
+        flask_app.debug = True
+        # Within budget, so just logged for debugging
+        with self.assertLogs(flask_app.logger, 'DEBUG') as logs:
+            self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual([r.levelname for r in logs.records], ['DEBUG'])
+        view.query_budget = 0
+        with self.assertLogs(flask_app.logger, 'WARNING') as logs:
+            self.app.get('/bookmarks', headers=self.headers)
+            self.app.get('/bookmarks', headers=self.headers)
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('over its budget of 0 queries', logs.output[0])
+        self.assertNotIn('Repeated', logs.output[0])
+        # Repeated statements are listed
+        with self.assertLogs(flask_app.logger, 'WARNING'):
+            with self.assertQueries(4) as log:
+                self.app.get('/bookmarks', headers=self.headers)
+                self.app.get('/bookmarks', headers=self.headers)
+        self.assertIn(' x2', log.summary())
+
+    # Test bookmark stats are read from hourly and daily rollups
+    def test_bookmark_stats(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        now = time.time()
+        old = bucket_start(now - 10 * 86400, 'hour')
+        recent = bucket_start(now, 'hour')
+        engine = bookmarks_service.database.engine
+        with engine.begin() as conn:
+            click_counter.write(conn, Counter({('abc123', old): 2,
+                                               ('abc123', recent): 3}))
+        # Counts for the same hour are added to
+        with engine.begin() as conn:
+            click_counter.write(conn, Counter({('abc123', recent): 1}))
+        url = '/bookmarks/abc123/stats'
+        rv = self.app.get(url, headers=self.headers)
+        self.assertEqual(rv.status_code, 200)
+        stats = json.loads(rv.data.decode())['stats']
+        self.assertEqual(stats['granularity'], 'hour')
+        self.assertEqual(stats['buckets'], [{'start': recent, 'hits': 4}])
+        # Old hourly stats are rolled up into daily stats
+        self.assertEqual(compact_stats(now), 1)
+        rv = self.app.get(url + '?granularity=hour&from=0',
+                          headers=self.headers)
+        self.assertEqual(json.loads(rv.data.decode())['stats']['buckets'],
+                         [{'start': recent, 'hits': 4}])
+        rv = self.app.get(url + '?granularity=day&from=0',
+                          headers=self.headers)
+        self.assertEqual(json.loads(rv.data.decode())['stats']['buckets'], [
+            {'start': bucket_start(old, 'day'), 'hits': 2},
+            {'start': bucket_start(recent, 'day'), 'hits': 4}])
+        # Bookmark hit count is kept too
+        rv = self.app.get('/bookmarks/abc123', headers=self.headers)
+        self.assertEqual(json.loads(rv.data.decode())['bookmark']['hits'], 6)
+
+    # Test compactions running at the same time count each hour once
+    @unittest.skipUnless(
+        bookmarks_service.database.engine.url.drivername != 'sqlite' or
+        bookmarks_service.database.engine.url.database,
+        'Concurrent compaction test needs a database file')
+    def test_concurrent_compaction(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        now = time.time()
+        old = bucket_start(now - 10 * 86400, 'hour')
+        engine = bookmarks_service.database.engine
+        with engine.begin() as conn:
+            click_counter.write(conn, Counter({('abc123', old): 5}))
+        # One compaction is half way through when another starts
+        first = engine.connect()
+        transaction = first.begin()
+        self.assertEqual(roll_up_stats(first, bucket_start(now, 'day')), 1)
+        removed = []
+        second = threading.Thread(
+            target=lambda: removed.append(compact_stats(now)))
+        second.start()
+        second.join(0.5)
+        self.assertTrue(second.is_alive())
+        transaction.commit()
+        first.close()
+        second.join()
+        self.assertEqual(removed, [0])
+        rv = self.app.get('/bookmarks/abc123/stats?granularity=day&from=0',
+                          headers=self.headers)
+        self.assertEqual(json.loads(rv.data.decode())['stats']['buckets'],
+                         [{'start': bucket_start(old, 'day'), 'hits': 5}])
+
+    # Test workers writing the first clicks of a bucket at once add them up
+    def test_concurrent_stats_insert(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        hour = bucket_start(time.time(), 'hour')
+        engine = bookmarks_service.database.engine
+        # One worker has inserted the new row, but not committed yet
+        first = engine.connect()
+        transaction = first.begin()
+        add_stats(first, 'hour', {('abc123', hour): 1})
+        errors = []
+
+        def flush():
+            try:
+                with engine.begin() as conn:
+                    add_stats(conn, 'hour', {('abc123', hour): 2})
+            except Exception as e:
+                errors.append(e)
+        second = threading.Thread(target=flush)
+        second.start()
+        second.join(0.5)
+        transaction.commit()
+        first.close()
+        second.join()
+        self.assertEqual(errors, [])
+        rv = self.app.get('/bookmarks/abc123/stats?from=0',
+                          headers=self.headers)
+        self.assertEqual(json.loads(rv.data.decode())['stats']['buckets'],
+                         [{'start': hour, 'hits': 3}])
+
+    # Test bookmark stats errors
+    def test_bookmark_stats_errors(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        rv = self.app.get('/bookmarks/abc123/stats?granularity=week',
+                          headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.get('/bookmarks/abc123/stats?from=yesterday',
+                          headers=self.headers)
+        self.assertEqual(rv.status_code, 400)
+        rv = self.app.get('/bookmarks/a1b2c3/stats', headers=self.headers)
+        self.assertEqual(rv.status_code, 404)
+
+
+class IdAllocatorTestCase(BaseTestCase):
+    # Test permutation allocator hands out unique ids in blocks
+    def test_permutation_allocator(self):
+        allocator = PermutationAllocator('key', block_size=10, name='test')
+        ids = allocator.allocate(25)
+        self.assertEqual(len(set(ids)), 25)
+        for b_id in ids:
+            self.assertTrue(re.fullmatch('^[0-9a-z]{6}$', b_id))
+        # Three blocks were reserved
+        counter = bookmarks_service.database.db_session.query(
+            IdCounter).get('test')
+        self.assertEqual(counter.next_value, 30)
+        # Another process gets the next block
+        other = PermutationAllocator('key', block_size=10, name='test')
+        self.assertFalse(set(ids) & set(other.allocate(10)))
+
+    # Test a small id space is handed out completely, and then runs out
+    def test_permutation_exhausted(self):
+        allocator = PermutationAllocator('key', block_size=500, name='test',
+                                         length=2)
+        ids = allocator.allocate(36 * 36)
+        self.assertEqual(len(set(ids)), 36 * 36)
+        self.assertTrue(all(len(b_id) == 2 for b_id in ids))
+        with self.assertRaises(RuntimeError):
+            allocator.allocate(1)
+
+    # Test ids used by other routes are never allocated
+    def test_reserved_ids(self):
+        allocator = PermutationAllocator('key', block_size=10)
+        # Permutation that maps the first counter value to a reserved id
+        allocator.permute = lambda n: int('export', 36) if n == 0 else n
+        ids = allocator.allocate(3)
+        self.assertEqual(len(ids), 3)
+        self.assertNotIn('export', ids)
+
+    # Test permutation stays inside id space and does not repeat
+    def test_permutation(self):
+        allocator = PermutationAllocator('key', block_size=10)
+        values = [allocator.permute(n) for n in range(10000)]
+        self.assertEqual(len(set(values)), 10000)
+        self.assertTrue(all(0 <= v < ID_SPACE for v in values))
+
+
+class MigrationTestCase(BaseTestCase):
+    # Test database from before migrations is brought up to date
+    def test_migrate_legacy_database(self):
+        database = bookmarks_service.database
+        database.db_session.remove()
+        database.Base.metadata.drop_all(bind=database.engine)
+        # Tables as they were before migrations
+        database.engine.execute(
+            'CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR(120), '
+            'email VARCHAR(256) NOT NULL UNIQUE, '
+            'password_hash VARCHAR(60) NOT NULL)')
+        database.engine.execute(
+            'CREATE TABLE bookmarks (id VARCHAR(6) PRIMARY KEY, '
+            'url TEXT NOT NULL, user_id INTEGER)')
+        database.engine.execute(
+            'CREATE TABLE api_keys (id VARCHAR(24) PRIMARY KEY, '
+            'secret VARCHAR(60) NOT NULL, user_id INTEGER)')
+        database.engine.execute(
+            "INSERT INTO bookmarks VALUES ('abc123', 'http://a.com/', 1)")
+        database.engine.execute(
+            "INSERT INTO bookmarks VALUES ('abc124', 'http://a.com/#b', 1)")
+        version = migrate()
+        self.assertEqual(version, len(migrations))
+        inspector = inspect(database.engine)
+        columns = [c['name'] for c in inspector.get_columns('bookmarks')]
+        self.assertIn('status', columns)
+        self.assertIn('hits', columns)
+        self.assertIn('bookmarks_version', [
+            c['name'] for c in inspector.get_columns('users')])
+        self.assertIn('ix_bookmarks_user_id_id',
+                      [i['name'] for i in inspector.get_indexes('bookmarks')])
+        self.assertIn('id_counters', inspector.get_table_names())
+        self.assertIn('ix_bookmark_stats_granularity_bucket', [
+            i['name'] for i in inspector.get_indexes('bookmark_stats')])
+        b = database.db_session.query(Bookmark).get('abc123')
+        self.assertEqual(b.status, 'verified')
+        self.assertEqual(b.url_hash, url_hash('http://a.com/'))
+        # Migrating again does nothing
+        self.assertEqual(migrate(), len(migrations))
+
+    # Test hashes made before fragments were hashed are replaced
+    def test_migrate_fragment_hashes(self):
+        self.add_bookmark_row('abc123', 'http://a.com/#b', 1)
+        table = Bookmark.__table__
+        with bookmarks_service.database.engine.begin() as conn:
+            # Hash as it was before fragments were included
+            conn.execute(table.update().values(
+                url_hash=url_hash('http://a.com/')))
+            set_version(conn, migrations.index(hash_url_fragments))
+        migrate()
+        bookmarks_service.database.db_session.expire_all()
+        b = bookmarks_service.database.db_session.query(Bookmark).get(
+            'abc123')
+        self.assertEqual(b.url_hash, url_hash('http://a.com/#b'))
+        self.assertNotEqual(b.url_hash, url_hash('http://a.com/'))
+
+
+class RedirectTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        rv = self.create_user(
+            'John Smith',
+            'jsmith22@me.com',
+            '22John!Smith44'
+        )
+        self.user_id = json.loads(rv.data.decode())['user']['id']
+
+    # Test short link redirects to saved url without authentication
+    def test_redirect(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        rv = self.app.get('/abc123')
+        self.assertEqual(rv.status_code, 302)
+        self.assertEqual(rv.headers['Location'], 'http://www.google.com/')
+
+    # Test redirect errors
+    def test_redirect_errors(self):
+        # Not a bookmark id
+        rv = self.app.get('/abc')
+        self.assertEqual(rv.status_code, 404)
+        # Bookmark id that does not exist
+        rv = self.app.get('/a1b2c3')
+        self.assertEqual(rv.status_code, 404)
+        self.assertIn(b'There is no bookmark with the id=a1b2c3', rv.data)
+
+    # Test only verified bookmarks redirect
+    def test_redirect_unverified(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id, status='pending')
+        rv = self.app.get('/abc123')
+        self.assertEqual(rv.status_code, 404)
+
+    # Test repeated redirects are served from cache
+    def test_redirect_cache(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        for _ in range(3):
+            rv = self.app.get('/abc123')
+            self.assertEqual(rv.status_code, 302)
+        rv = self.app.get('/stats', headers=self.super_user_headers)
+        stats = json.loads(rv.data.decode())['stats']['caches']
+        self.assertEqual(stats['redirects']['misses'], 1)
+        self.assertEqual(stats['redirects']['hits'], 2)
+
+    # Test clicks are counted and written in a batch
+    def test_click_counts(self):
+        self.add_bookmark_row('abc123', 'http://www.google.com/',
+                              self.user_id)
+        self.add_bookmark_row('def456', 'http://www.google.com/',
+                              self.user_id)
+        for bookmark_id in ('abc123', 'abc123', 'def456'):
+            self.app.get('/' + bookmark_id)
+        self.assertEqual(click_counter.stats()['pending'], 3)
+        self.assertEqual(click_counter.flush(), 3)
+        db_session = bookmarks_service.database.db_session
+        self.assertEqual(db_session.query(Bookmark).get('abc123').hits, 2)
+        self.assertEqual(db_session.query(Bookmark).get('def456').json()[
+            'hits'], 1)
+        # Nothing left to write
+        self.assertEqual(click_counter.flush(), 0)
+
+    # Test clicks beyond max_pending are dropped, and failed flushes keep
+    # their counts
+    def test_click_counter_bounds(self):
+        counter = ClickCounter(flush_size=100, flush_interval=60,
+                               max_pending=3, compact_interval=3600)
+        counter.write = lambda conn, counts: 1 / 0
+        for _ in range(5):
+            counter.record('abc123')
+        self.assertEqual(counter.stats()['pending'], 3)
+        self.assertEqual(counter.stats()['dropped'], 2)
+        self.assertEqual(counter.flush(), 0)
+        self.assertEqual(counter.stats()['pending'], 3)
+        self.assertEqual(counter.stats()['failed_flushes'], 1)
+        counter.close()
+
 
 if __name__ == '__main__':
     # Make sure we are in testing mode and testing env